@@ -1,26 +1,110 @@
 #!/usr/bin/env python3
+import asyncio
 import logging
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters,CallbackQueryHandler
-from musicbot.config import TG_TOKEN, init_dirs
-from musicbot.db import init_db
-from musicbot.handlers import start, handle_video, handle_link, handle_text, handle_choice
+import signal
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from musicbot.config import (
+    TG_TOKEN, JOB_CONCURRENCY, JOB_QUEUE_SIZE, UPDATE_CONCURRENCY,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET, METRICS_PORT, init_dirs, cover_bytes,
+)
+from musicbot.db import init_db, close_db
+from musicbot.workers import shutdown_workers
+from musicbot.cache import reconcile, enforce_budget, maintenance_loop, is_maintainer
+from musicbot.pipeline import run_background
+from musicbot.audd import client as audd_client
+from musicbot.search_cache import search_cache_stats
+from musicbot import choices
+from musicbot.handlers import register_handlers
+from musicbot.metrics import register_gauges
+from musicbot.scheduler import scheduler_stats
+from musicbot.singleflight import flight_stats
+from musicbot.workers import pool_stats
+from musicbot.prefetch import prefetch_stats
+from musicbot.batch import batch_stats
+from musicbot.inline import inline_stats
+
+def register_metrics():
+    """Текущая нагрузка: планировщик, single-flight, пул yt-dlp, предзагрузки, клавиатуры, пакеты, inline, кэш поиска.
+    Монотонные величины (запросы, попадания, отмены) — счётчики metrics.inc, не gauge."""
+    for stage in scheduler_stats():
+        register_gauges(f"scheduler_{stage}", lambda stage=stage: scheduler_stats()[stage])
+    register_gauges("single_flight", flight_stats)
+    register_gauges("ytdlp_pool", pool_stats)
+    register_gauges("prefetch", prefetch_stats)
+    register_gauges("choices", choices.choice_stats)
+    register_gauges("batches", batch_stats)
+    register_gauges("inline", inline_stats)
+    register_gauges("search_cache", search_cache_stats)
+
+async def on_startup(app):
+    await audd_client.start()
+    # битые пути и файлы-сироты убираем до первого запроса (один воркер на общий кэш)
+    if await is_maintainer():
+        await reconcile()
+        await enforce_budget()
+    run_background(maintenance_loop())
+    await choices.restore()
+    run_background(choices.sweeper(app.bot))
+    if METRICS_PORT:
+        # и в режиме webhook — отдельно от публичного порта
+        from musicbot.webserver import make_metrics_app, start_web_server
+        app.bot_data["metrics_runner"] = await start_web_server(make_metrics_app(), METRICS_PORT, host="127.0.0.1")
+
+async def on_shutdown(app):
+    await audd_client.close()
+    if runner := app.bot_data.pop("metrics_runner", None):
+        await runner.cleanup()
+
+async def run_webhook(app):
+    """Webhook через собственный aiohttp-сервер (post_init/post_shutdown вызываем сами)."""
+    from musicbot.webserver import make_web_app, start_web_server
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with app:
+        await on_startup(app)
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+        )
+        await app.start()
+        runner = await start_web_server(make_web_app(app), WEBHOOK_PORT)
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+            await app.stop()
+            await on_shutdown(app)
 
 def main():
     logging.getLogger("HybridMusicBot").info("🚀 Hybrid bot starting...")
     init_dirs()
     init_db()
+    cover_bytes()
+    register_metrics()
 
-    app = ApplicationBuilder().token(TG_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.VIDEO & ~filters.COMMAND, handle_video))
-
-    # ссылки
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'https?://'), handle_link))
-
-    # обычный текст (название трека)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(r'https?://'), handle_text))
-    app.add_handler(CallbackQueryHandler(handle_choice))
-    app.run_polling()
+    app = (
+        ApplicationBuilder()
+        .token(TG_TOKEN)
+        # апдейты обрабатываются параллельно; тяжёлую работу дозирует musicbot.scheduler
+        .concurrent_updates(UPDATE_CONCURRENCY or JOB_CONCURRENCY + JOB_QUEUE_SIZE + 32)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    register_handlers(app)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
+    shutdown_workers()
+    close_db()
 
 if __name__ == "__main__":
     main()
@@ -1,44 +1,155 @@
+import asyncio
 import aiohttp
+import json
 import time
 from pathlib import Path
-from .config import AUDD_TOKEN, log
-
-async def audd_recognize(mp3_path: Path):
-    url = "https://api.audd.io/"
-    start_time = time.time()
-
-    try:
-        size = mp3_path.stat().st_size
-        log.info(f"[AUDD] ▶ Отправляю файл '{mp3_path.name}' ({size / 1024:.1f} KB) на распознавание...")
-
-        async with aiohttp.ClientSession() as s:
-            with open(mp3_path, "rb") as f:
-                form = aiohttp.FormData()
-                form.add_field("api_token", AUDD_TOKEN)
-                form.add_field("file", f, filename=mp3_path.name, content_type="audio/mpeg")
-                async with s.post(url, data=form, timeout=20) as r:
-                    text = await r.text()
-                    try:
-                        js = await r.json()
-                    except Exception:
-                        log.error(f"[AUDD] ❌ Ошибка парсинга JSON: {text}")
-                        return None
-
-        duration = time.time() - start_time
-        log.info(f"[AUDD] ⏱ Ответ за {duration:.2f} сек. Статус: {js.get('status')}")
-
-        if js.get("status") != "success":
-            log.warning(f"[AUDD] ⚠ Статус {js.get('status')}, ответ: {js}")
-            return None
+from .config import AUDD_TOKEN, AUDD_URL, AUDD_CONCURRENCY, AUDD_RETRIES, AUDD_TIMEOUT, AUDD_RETURN, AUDD_NEGATIVE_TTL, log
+from .metrics import inc, timed
+from .scheduler import stage
+from .db import get_recognition, save_recognition, purge_negative_recognitions
+
+class AuddClient:
+    """
+    Клиент AUDD с одной keep-alive сессией на всё время работы бота:
+    DNS и TLS-рукопожатие оплачиваются один раз, а не на каждый запрос.
+    Создаётся в bot.py (start/close), url можно подменить локальным сервером.
+    Число одновременных запросов ограничивает этап "audd" планировщика, здесь —
+    только размер пула соединений. Время запроса — musicbot_stage_seconds{stage="audd"}.
+    """
+
+    def __init__(self, token: str, url: str = AUDD_URL, concurrency: int = AUDD_CONCURRENCY,
+                 retries: int = AUDD_RETRIES, timeout: float = AUDD_TIMEOUT):
+        self.token = token
+        self.url = url
+        self.retries = retries
+        self.timeout = timeout
+        self._concurrency = concurrency
+        self._session: aiohttp.ClientSession | None = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._concurrency, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def query(self, mp3_path: Path) -> dict | None:
+        """Сырой ответ AUDD; None — запрос не удался (сеть, 5xx, не JSON)."""
+        start_time = time.time()
+        await self.start()
 
-        if not js.get("result"):
-            log.warning(f"[AUDD] ❌ Нет результата: {js}")
+        try:
+            size = mp3_path.stat().st_size
+            log.info(f"[AUDD] ▶ Отправляю файл '{mp3_path.name}' ({size / 1024:.1f} KB) на распознавание...")
+
+            js = await self._post(mp3_path)
+            if js is not None:
+                duration = time.time() - start_time
+                log.info(f"[AUDD] ⏱ Ответ за {duration:.2f} сек. Статус: {js.get('status')}")
+            return js
+
+        except Exception as e:
+            inc("audd_errors")
+            log.error(f"[AUDD] 💥 Ошибка при обращении к API: {e}")
             return None
 
-        result = js["result"]
-        log.info(f"[AUDD] ✅ Распознан: {result.get('artist')} — {result.get('title')}")
-        return result
+    async def _post(self, mp3_path: Path) -> dict | None:
+        """Один запрос с повторами на 5xx и таймаутах (экспоненциальная пауза)."""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                inc("audd_retries")
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+            inc("audd_requests")
+            try:
+                with open(mp3_path, "rb") as f:
+                    form = aiohttp.FormData()
+                    form.add_field("api_token", self.token)
+                    if AUDD_RETURN:
+                        form.add_field("return", AUDD_RETURN)
+                    form.add_field("file", f, filename=mp3_path.name, content_type="audio/mpeg")
+                    async with self._session.post(self.url, data=form) as r:
+                        if r.status >= 500:
+                            log.warning(f"[AUDD] ⚠ HTTP {r.status}, попытка {attempt + 1}/{self.retries + 1}")
+                            continue
+                        text = await r.text()
+            except (asyncio.TimeoutError, aiohttp.ServerDisconnectedError) as e:
+                log.warning(f"[AUDD] ⏱ {type(e).__name__}, попытка {attempt + 1}/{self.retries + 1}")
+                continue
+
+            # тело читаем один раз и разбираем сами
+            try:
+                return json.loads(text)
+            except Exception:
+                log.error(f"[AUDD] ❌ Ошибка парсинга JSON: {text}")
+                return None
+
+        inc("audd_errors")
+        log.error(f"[AUDD] ❌ API недоступно после {self.retries + 1} попыток")
+        return None
 
-    except Exception as e:
-        log.error(f"[AUDD] 💥 Ошибка при обращении к API: {e}")
+def result_of(js: dict | None) -> dict | None:
+    """Достаёт трек из ответа AUDD (None — не распознан или ошибка)."""
+    if js is None:
         return None
+
+    if js.get("status") != "success":
+        log.warning(f"[AUDD] ⚠ Статус {js.get('status')}, ответ: {js}")
+        return None
+
+    if not js.get("result"):
+        log.warning(f"[AUDD] ❌ Нет результата: {js}")
+        return None
+
+    result = js["result"]
+    log.info(f"[AUDD] ✅ Распознан: {result.get('artist')} — {result.get('title')}")
+    return result
+
+def track_duration(result: dict) -> int | None:
+    """Длительность трека в секундах из внешних метаданных (timecode — это позиция фрагмента)."""
+    if ms := (result.get("spotify") or {}).get("duration_ms"):
+        return int(ms) // 1000
+    if ms := ((result.get("apple_music") or {}).get("durationInMillis")):
+        return int(ms) // 1000
+    return None
+
+# клиент по умолчанию; bot.py открывает и закрывает его вместе с приложением
+client = AuddClient(AUDD_TOKEN)
+
+# === Кэш результатов распознавания ===
+async def recognize_cached(snip: Path, ahash: str) -> dict | None:
+    """
+    Распознавание фрагмента с кэшем по его хэшу: успешный ответ хранится целиком
+    (альбом, длительность, внешние id), «не распознано» — AUDD_NEGATIVE_TTL секунд.
+    Сетевые ошибки и отказы API не кэшируются.
+    """
+    now = time.time()
+    if row := await get_recognition(ahash):
+        result, created_at = row
+        if result is not None:
+            inc("audd_cache_lookups", result="hit")
+            log.info(f"[AUDD] ⚡ Ответ из кэша для {ahash}")
+            return json.loads(result)
+        if now - created_at < AUDD_NEGATIVE_TTL:
+            inc("audd_cache_lookups", result="negative_hit")
+            log.info(f"[AUDD] ⚡ {ahash} недавно не распознан — AUDD не вызываю")
+            return None
+
+    inc("audd_cache_lookups", result="miss")
+    async with stage("audd"), timed("audd"):
+        js = await client.query(snip)
+    result = result_of(js)
+    if result is not None:
+        await save_recognition(ahash, json.dumps(result, ensure_ascii=False), now)
+    elif js is not None and js.get("status") == "success":
+        await save_recognition(ahash, None, now)
+    return result
+
+async def purge_negative_cache() -> int:
+    return await purge_negative_recognitions(time.time() - AUDD_NEGATIVE_TTL)
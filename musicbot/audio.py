@@ -1,49 +1,168 @@
 import asyncio
 import hashlib
+import os
+import re
 import tempfile
+from dataclasses import dataclass
 from pathlib import Path
-from telegram import Update
-from telegram.ext import ContextTypes
-from .config import FFMPEG
-
-async def tg_download_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Path:
-    file = await context.bot.get_file(update.message.video.file_id)
-    tmp = Path(tempfile.mkstemp(suffix=".mp4")[1])
-    await file.download_to_drive(str(tmp))
+import numpy as np
+from telegram import Bot
+from .config import FFMPEG, log
+from .metrics import timed
+from .scheduler import stage
+from .fingerprint import SAMPLE_RATE as PCM_RATE, _to_float
+
+# окна-кандидаты (начало, длительность) для распознавания; первое — прежнее окно по умолчанию
+SNIP_WINDOWS = ((5, 25), (0, 12), (20, 15), (35, 15), (50, 15))
+SNIP_END = max(s + d for s, d in SNIP_WINDOWS)
+# клип для AUDD: моно, 22 кГц, 64 кбит/с — распознаванию хватает, загрузка в ~6 раз меньше
+SNIP_RATE = 22050
+SNIP_BITRATE = "64k"
+MIN_SNIP_BYTES = 32_000       # ~4 сек звука при 64k
+RANK_FRAME = 2048
+
+async def tg_download_video(bot: Bot, file_id: str) -> Path:
+    async with timed("tg_download"):
+        file = await bot.get_file(file_id)
+        fd, name = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        tmp = Path(name)
+        await file.download_to_drive(str(tmp))
     return tmp
 
-async def extract_audio_snip(video_path: Path, start: int = 5, duration: int = 25) -> Path | None:
+async def tg_video_source(bot: Bot, file_id: str) -> str | Path:
+    """
+    Источник видео для ffmpeg без скачивания: HTTPS-ссылка на файл Telegram
+    (ffmpeg читает по Range только нужные байты) или локальный путь,
+    если бот работает через локальный Bot API сервер.
+    """
+    async with timed("tg_get_file"):
+        file = await bot.get_file(file_id)
+    if file.file_path and file.file_path.startswith(("http://", "https://")):
+        return file.file_path
+    return Path(file.file_path)
+
+def _redact(text: str) -> str:
+    # в ссылке на файл Telegram зашит токен бота
+    return re.sub(r"/bot[^/\s]+/", "/bot***/", text)
+
+@dataclass
+class Window:
+    start: int
+    duration: int
+    path: Path
+    score: float = 0.0
+    ahash: str = ""
+
+@dataclass
+class Clip:
+    """Окна-кандидаты одного видео (лучшие первыми) и моно PCM всего прочитанного отрезка."""
+    windows: list[Window]
+    pcm: np.ndarray
+    ahash: str = ""
+
+    def cleanup(self):
+        for w in self.windows:
+            w.path.unlink(missing_ok=True)
+
+def _window_score(pcm: np.ndarray) -> float:
+    """Громкость × «музыкальность» (1 − спектральная плоскостность: шум и речь плоские, музыка тональная)."""
+    n = len(pcm) // RANK_FRAME * RANK_FRAME
+    if n < PCM_RATE * 4:
+        return 0.0
+    frames = pcm[:n].reshape(-1, RANK_FRAME)
+    rms_db = 10 * np.log10(np.mean(frames ** 2) + 1e-10)
+    loudness = min(max((rms_db + 50) / 40, 0.0), 1.0)      # -50 дБ → 0, -10 дБ → 1
+    power = np.abs(np.fft.rfft(frames * np.hanning(RANK_FRAME), axis=1)) ** 2 + 1e-12
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    return loudness * float(1 - np.mean(flatness))
+
+async def extract_clip(
+    source: Path | str,
+    windows: tuple[tuple[int, int], ...] = SNIP_WINDOWS,
+    headers: dict | None = None,
+) -> Clip | None:
     """
-    Извлекает звуковой фрагмент из видео, удаляет тишину и усиливает громкость.
-    По умолчанию — с 5-й секунды длительностью 25 сек.
+    Один проход ffmpeg по первым SNIP_END секундам: по маленькому моно-mp3 на каждое окно
+    (без тишины, с усилением громкости) и моно PCM в память для ранжирования,
+    отпечатка и хэша. Записанные файлы повторно не читаются.
+    source — локальный файл или URL: из URL ffmpeg читает только нужный диапазон.
+    headers — HTTP-заголовки для URL (например, от yt-dlp).
+    Короткие ролики дают меньше окон; если ни одно не набрало звука — None.
     """
-    snip = video_path.with_suffix(".mp3")
-
-    cmd = [
-        FFMPEG, "-hide_banner", "-loglevel", "error",
-        "-y", "-i", str(video_path),
-        "-ss", str(start),            # пропускаем первые 5 сек
-        "-t", str(duration),          # вырезаем 25 сек
-        "-vn",                        # без видео
-        "-ac", "2",                   # 2 канала
-        "-ar", "44100",               # частота дискретизации
-        "-b:a", "192k",               # битрейт
-        "-af", "silenceremove=stop_periods=-1:stop_threshold=-50dB:stop_duration=0.5,volume=2.0",
-        str(snip)
-    ]
-
-    proc = await asyncio.create_subprocess_exec(*cmd)
-    await proc.communicate()
-
-    # Проверим, что файл не пустой (есть звук)
-    if not snip.exists() or snip.stat().st_size < 100_000:
-        print(f"⚠️ {snip.name} слишком маленький — возможно, нет аудиодорожки")
+    remote = isinstance(source, str)
+    end = max(s + d for s, d in windows)
+    paths = []
+    for _ in windows:
+        fd, name = tempfile.mkstemp(suffix=".mp3")
+        os.close(fd)
+        paths.append(Path(name))
+
+    cmd = [FFMPEG, "-hide_banner", "-loglevel", "error", "-y"]
+    if remote:
+        cmd += ["-reconnect", "1", "-rw_timeout", "15000000"]
+        if headers:
+            cmd += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    cmd += ["-t", str(end), "-i", str(source)]     # -t до -i: дальше конца окон вход не читается
+    for (start, duration), path in zip(windows, paths):
+        cmd += [
+            "-ss", str(start),          # у выхода: декодирование общее, лишнее просто отбрасывается
+            "-t", str(duration),
+            "-vn",                      # без видео
+            "-ac", "1",                 # моно
+            "-ar", str(SNIP_RATE),      # частота дискретизации
+            "-b:a", SNIP_BITRATE,       # битрейт
+            "-af", "silenceremove=stop_periods=-1:stop_threshold=-50dB:stop_duration=0.5,volume=2.0",
+            str(path),
+        ]
+    cmd += ["-vn", "-ac", "1", "-ar", str(PCM_RATE), "-f", "s16le", "pipe:1"]
+
+    async with stage("ffmpeg"), timed("ffmpeg_snippet"):
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                raw, err = await proc.communicate()
+            except BaseException:
+                # запрос отменён — ffmpeg не должен дочитывать источник в пустоту
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+        except BaseException:
+            for path in paths:
+                path.unlink(missing_ok=True)
+            raise
+    if proc.returncode and err:
+        log.warning(f"[ffmpeg] ⚠ {_redact(err.decode(errors='ignore').strip())}")
+
+    raw = raw[:len(raw) // 2 * 2]
+    pcm = _to_float(raw)
+    clip = Clip(windows=[], pcm=pcm)
+    for (start, duration), path in zip(windows, paths):
+        # окно за концом ролика или почти без звука
+        if not path.exists() or path.stat().st_size < MIN_SNIP_BYTES:
+            path.unlink(missing_ok=True)
+            continue
+        lo, hi = start * PCM_RATE, (start + duration) * PCM_RATE
+        clip.windows.append(Window(
+            start, duration, path,
+            score=_window_score(pcm[lo:hi]),
+            ahash=content_hash(raw[lo * 2:hi * 2]),
+        ))
+
+    if not clip.windows:
+        print("⚠️ Во всех окнах слишком мало звука — возможно, нет аудиодорожки")
         return None
 
-    return snip
+    # ключ кэша — окно по умолчанию, как и раньше; иначе лучшее из доступных
+    key = next((w for w in clip.windows if (w.start, w.duration) == windows[0]), None)
+    clip.windows.sort(key=lambda w: w.score, reverse=True)
+    clip.ahash = (key or clip.windows[0]).ahash
+    log.info("[Audio] 🎚 Окна: " + ", ".join(f"{w.start}+{w.duration}s={w.score:.2f}" for w in clip.windows))
+    return clip
 
-def audio_hash(path: Path) -> str:
-    """MD5 первых ~200 КБ звука"""
-    with open(path, "rb") as f:
-        data = f.read(200_000)
-    return hashlib.md5(data).hexdigest()
+def content_hash(pcm: bytes) -> str:
+    """MD5 декодированного звука: не зависит от контейнера, кодека и битрейта источника."""
+    return hashlib.md5(pcm).hexdigest()
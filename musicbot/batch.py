@@ -0,0 +1,162 @@
+"""
+Пакетный режим: несколько ссылок в одном сообщении или ссылка на плейлист.
+Каждая ссылка — отдельная задача планировщика, у пользователя одновременно
+обрабатывается не больше BATCH_USER_CONCURRENCY. Трек отправляется, как только
+готов, а ход работы виден в одном сообщении, которое редактируется.
+"""
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict
+from telegram import Message
+from telegram.error import RetryAfter, TelegramError
+from .cache import record_lookup, is_deliverable
+from .config import BATCH_MAX_ITEMS, BATCH_USER_CONCURRENCY, BATCH_PROGRESS_INTERVAL, YTDLP_SEARCH_TIMEOUT, log
+from .db import get_by_url
+from .delivery import send_track
+from .metrics import timed
+from .pipeline import PipelineError, ingest_link
+from .scheduler import QueueFull, job
+from .workers import run_blocking
+from .youtube import expand_playlist, is_playlist
+
+URL_RE = re.compile(r"https?://[^\s<>\"']+")
+
+def find_urls(text: str) -> list[str]:
+    # запятая/точка/скобка после ссылки в тексте — не часть адреса
+    return [u.rstrip(".,;:!?)]") for u in URL_RE.findall(text or "")]
+
+def is_batch(urls: list[str]) -> bool:
+    return len(urls) > 1 or any(is_playlist(u) for u in urls)
+
+# === Лимит на пользователя (общий для всех его пакетов) ===
+class _UserSlots:
+    __slots__ = ("sem", "batches")
+
+    def __init__(self):
+        self.sem = asyncio.Semaphore(BATCH_USER_CONCURRENCY)
+        self.batches = 0
+
+_slots: Dict[int, _UserSlots] = {}
+
+def _acquire_slots(user_id: int) -> _UserSlots:
+    s = _slots.get(user_id)
+    if s is None:
+        s = _slots[user_id] = _UserSlots()
+    s.batches += 1
+    return s
+
+def _release_slots(user_id: int):
+    s = _slots[user_id]
+    s.batches -= 1
+    if not s.batches:
+        del _slots[user_id]
+
+# === Прогресс ===
+@dataclass(slots=True)
+class Progress:
+    status: Message
+    total: int
+    done: int = 0
+    cached: int = 0
+    failed: list[str] = field(default_factory=list)
+    shown_at: float = 0.0
+
+    def text(self, final: bool = False) -> str:
+        head = "✅ Готово" if final else "📦 Обрабатываю"
+        lines = [f"{head}: {self.done}/{self.total}"]
+        if self.cached:
+            lines.append(f"⚡ из кэша: {self.cached}")
+        if self.failed:
+            lines.append(f"⚠️ не удалось: {len(self.failed)}")
+            if final:
+                lines += [f"• {f}" for f in self.failed[:10]]
+        return "\n".join(lines)
+
+    async def show(self, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self.shown_at < BATCH_PROGRESS_INTERVAL:
+            return
+        self.shown_at = now
+        try:
+            await self.status.edit_text(self.text(final)[:4000])
+        except TelegramError as e:
+            # «message is not modified», лимит правок, сеть — следующее обновление покажет актуальное
+            log.debug(f"[Batch] Прогресс не обновлён: {e}")
+
+# === Обработка ===
+async def _expand(urls: list[str]) -> list[str]:
+    items = []
+    for url in urls:
+        if not is_playlist(url):
+            items.append(url)
+            continue
+        try:
+            async with timed("playlist_expand"):
+                items += await run_blocking(expand_playlist, url, BATCH_MAX_ITEMS, timeout=YTDLP_SEARCH_TIMEOUT)
+        except Exception as e:
+            log.error(f"[Batch] ❌ Не удалось раскрыть плейлист {url}: {e}")
+    # одна и та же ссылка дважды — одна задача
+    return list(dict.fromkeys(items))[:BATCH_MAX_ITEMS]
+
+async def _deliver(message: Message, track: dict, performer: str):
+    try:
+        await send_track(message, track, performer=performer)
+    except RetryAfter as e:
+        # много треков подряд в один чат — Telegram просит подождать
+        await asyncio.sleep(e.retry_after)
+        await send_track(message, track, performer=performer)
+
+async def _process(message: Message, url: str, performer: str, slots: _UserSlots, progress: Progress):
+    try:
+        async with slots.sem:
+            cached = await get_by_url(url)
+            hit = bool(cached and is_deliverable(cached))
+            record_lookup("url", hit)
+            if hit:
+                track = cached
+                progress.cached += 1
+            else:
+                async with job(message.from_user.id):
+                    track = await ingest_link(url)
+        # отправка — уже вне лимита: слот нужен следующей ссылке
+        await _deliver(message, track, performer)
+    except PipelineError as e:
+        progress.failed.append(f"{url} — {e}")
+    except QueueFull:
+        progress.failed.append(f"{url} — бот перегружен")
+    except Exception as e:
+        log.error(f"[Batch] ❌ {url}: {e}", exc_info=True)
+        progress.failed.append(f"{url} — ошибка")
+    finally:
+        progress.done += 1
+        await progress.show()
+
+async def run_batch(message: Message, urls: list[str], performer: str):
+    status = await message.reply_text(f"📦 Ссылок: {len(urls)}, собираю список треков...")
+    items = await _expand(urls)
+    if not items:
+        await status.edit_text("⚠️ Не нашёл ни одного трека по ссылкам.")
+        return
+
+    progress = Progress(status, len(items))
+    await progress.show()
+    log.info(f"[Batch] 📦 {message.from_user.id}: {len(items)} ссылок")
+
+    slots = _acquire_slots(message.from_user.id)
+    try:
+        # до освобождения слотов дожидаемся всех ссылок: иначе следующий пакет получит
+        # новый семафор, пока старые задачи ещё держат этот
+        results = await asyncio.gather(
+            *(_process(message, url, performer, slots, progress) for url in items), return_exceptions=True,
+        )
+    finally:
+        _release_slots(message.from_user.id)
+    for url, result in zip(items, results):
+        if isinstance(result, BaseException):
+            log.error(f"[Batch] ❌ {url}: {result!r}")
+    await progress.show(final=True)
+
+def batch_stats() -> Dict[str, int]:
+    return {"users": len(_slots), "batches": sum(s.batches for s in _slots.values())}
@@ -0,0 +1,404 @@
+"""
+Офлайн-бенчмарк: настоящие обработчики из musicbot.handlers, а Telegram Bot API,
+AUDD и YouTube/yt-dlp заменены локальными заглушками с настраиваемой задержкой.
+Сеть не нужна, нужен только ffmpeg.
+
+    python -m musicbot.bench --levels 1,4,16
+    python -m musicbot.bench --updates recorded.jsonl --tg-latency 0.05 --audd-latency 1.5
+
+Каждый уровень параллельности прогоняется в отдельном процессе с пустым кэшем:
+отчёт — пропускная способность, доля попаданий в кэш, p50/p95/p99 по этапам, CPU и пиковый RSS.
+
+Файл --updates — JSONL: либо настоящие апдейты Telegram (с update_id),
+либо сокращения:
+    {"type": "video", "media": 0}          видео со звуком №0 (media — номер сгенерированного тона)
+    {"type": "link", "media": 1}           ссылка, звук которой — тон №1
+    {"type": "text", "query": "song 3"}    поиск по названию
+    {"type": "tap", "index": 1}            нажатие кнопки в последней клавиатуре этого пользователя
+У сокращений можно указать "user" (id пользователя, по умолчанию 1).
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_TOKEN = "123456:bench"
+MEDIA_SECONDS = 70
+
+# === Рабочая нагрузка ===
+def default_workload(n: int, media: int, seed: int = 1) -> list[dict]:
+    """
+    Смесь как в проде: видео, ссылки, поиск с выбором; треки повторяются (кэш тоже меряем).
+    Звук выбирается независимо от вида запроса (seed — воспроизводимость), иначе каждый
+    вид видел бы лишь несколько треков и бенчмарк мерил бы одни попадания в кэш.
+    """
+    rng = random.Random(seed)
+    items = []
+    for i in range(n):
+        user = 1000 + i % 50
+        kind = i % 4
+        m = rng.randrange(media)
+        if kind == 0:
+            items.append({"type": "video", "media": m, "user": user})
+        elif kind == 1:
+            items.append({"type": "link", "media": m, "user": user})
+        else:
+            items.append({"type": "text", "query": f"bench song {m}", "user": user})
+            items.append({"type": "tap", "index": 1, "user": user})
+    return items
+
+def load_workload(path: Path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+
+def make_media(dst: Path, count: int) -> list[Path]:
+    """Тоны разной высоты вместо настоящей музыки: у каждого свой хэш и отпечаток."""
+    from .config import FFMPEG
+    files = []
+    for i in range(count):
+        path = dst / f"media{i}.mp3"
+        if not path.exists():
+            freq = 220 * 2 ** (i / 12)
+            subprocess.run([
+                FFMPEG, "-hide_banner", "-loglevel", "error", "-y",
+                "-f", "lavfi", "-i", f"sine=frequency={freq:.1f}:duration={MEDIA_SECONDS}",
+                "-f", "lavfi", "-i", f"sine=frequency={freq * 1.5:.1f}:duration={MEDIA_SECONDS}",
+                "-filter_complex", "amix=inputs=2", "-b:a", "128k", str(path),
+            ], check=True)
+        files.append(path)
+    return files
+
+# === Заглушки внешних сервисов ===
+class TelegramStandIn:
+    """Минимальный Bot API: отвечает валидными объектами и отдаёт файлы из media."""
+
+    def __init__(self, media: list[Path], latency: float):
+        self.media = media
+        self.latency = latency
+        self.ids = itertools.count(1)
+        self.keyboards: dict[int, str] = {}     # chat_id -> reply_markup последней клавиатуры
+        self.calls: dict[str, int] = {}
+
+    def app(self):
+        from aiohttp import web
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.file)
+        return app
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        return {"message_id": next(self.ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    async def method(self, request):
+        from aiohttp import web
+        name = request.match_info["method"]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        form = await request.post() if request.can_read_body else {}
+        await asyncio.sleep(self.latency)
+
+        chat_id = int(form.get("chat_id", 0) or 0)
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif name == "getFile":
+            file_id = form["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": 1, "file_path": f"media/{file_id}"}
+        elif name == "sendMessage":
+            if markup := form.get("reply_markup"):
+                self.keyboards[chat_id] = markup
+            result = self._message(chat_id, text=form.get("text", ""))
+        elif name == "sendAudio":
+            n = next(self.ids)
+            result = self._message(chat_id, audio={"file_id": f"audio{n}", "file_unique_id": f"ua{n}", "duration": 1})
+        elif name == "editMessageText":
+            result = self._message(chat_id, text=form.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request):
+        from aiohttp import web
+        # file_id вида media3 → media/media3.mp3
+        name = Path(request.match_info["path"]).name
+        index = int(name.removeprefix("media")) if name.startswith("media") else 0
+        return web.FileResponse(self.media[index % len(self.media)])
+
+class AuddStandIn:
+    """AUDD: одинаковый звук → одинаковый трек, задержка как у настоящего API."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = 0
+
+    def app(self):
+        from aiohttp import web
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/", self.recognize)
+        return app
+
+    async def recognize(self, request):
+        from aiohttp import web
+        self.requests += 1
+        form = await request.post()
+        data = form["file"].file.read()
+        await asyncio.sleep(self.latency)
+        n = int(hashlib.md5(data[:4096]).hexdigest(), 16) % 1000
+        return web.json_response({"status": "success", "result": {
+            "artist": "Bench Artist", "title": f"bench song {n}",
+            "spotify": {"duration_ms": MEDIA_SECONDS * 1000},
+        }})
+
+def patch_youtube(media_url: str, media_count: int, latency: float):
+    """yt-dlp не ходит в сеть: поиск и метаданные отдаются сразу, звук — с заглушки Telegram."""
+    from . import pipeline, youtube
+
+    def media_for(text: str) -> int:
+        digits = "".join(ch for ch in text if ch.isdigit())
+        return int(digits or 0) % media_count
+
+    def search_youtube_music(title, artist, duration=None):
+        time.sleep(latency)
+        return f"bench{media_for(title):06d}"[:11]
+
+    def search_youtube_list(query, limit=10):
+        time.sleep(latency)
+        base = media_for(query)
+        return [{
+            "id": f"bench{(base + i) % media_count:06d}"[:11], "title": f"bench song {(base + i) % media_count}",
+            "duration": MEDIA_SECONDS, "uploader": "bench - Topic", "url": "", "_priority": 10 - i,
+        } for i in range(min(limit, 5))]
+
+    def resolve_track(video_id):
+        time.sleep(latency)
+        return {"url": f"{media_url}/media{int(video_id[5:]) % media_count}",
+                "protocol": "http", "duration": MEDIA_SECONDS, "http_headers": {}}
+
+    def resolve_audio_stream(url):
+        time.sleep(latency)
+        return f"{media_url}/media{media_for(url)}", {}
+
+    youtube.search_youtube_music = search_youtube_music
+    youtube.search_youtube_list = search_youtube_list
+    youtube.resolve_track = resolve_track
+    pipeline.resolve_audio_stream = resolve_audio_stream
+
+# === Апдейты ===
+class UpdateFactory:
+    def __init__(self, tg: TelegramStandIn):
+        self.tg = tg
+        self.ids = itertools.count(1)
+
+    def __call__(self, item: dict) -> dict | None:
+        if "update_id" in item:
+            return item
+        user_id = item.get("user", 1)
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        chat = {"id": user_id, "type": "private"}
+        base = {"message_id": next(self.ids), "date": int(time.time()), "chat": chat, "from": user}
+        kind = item["type"]
+        if kind == "video":
+            fid = f"media{item.get('media', 0)}"
+            message = dict(base, video={"file_id": fid, "file_unique_id": fid, "width": 1, "height": 1, "duration": MEDIA_SECONDS})
+        elif kind == "link":
+            message = dict(base, text=f"https://example.com/watch?v={item.get('media', 0)}")
+        elif kind == "text":
+            message = dict(base, text=item["query"])
+        elif kind == "tap":
+            markup = self.tg.keyboards.get(user_id)
+            if not markup:
+                return None
+            buttons = json.loads(markup)["inline_keyboard"]
+            data = buttons[min(item.get("index", 1), len(buttons)) - 1][0]["callback_data"]
+            return {"update_id": next(self.ids), "callback_query": {
+                "id": str(next(self.ids)), "from": user, "chat_instance": "bench", "data": data,
+                "message": dict(base, text="keyboard"),
+            }}
+        else:
+            raise ValueError(f"неизвестный тип апдейта: {kind}")
+        return {"update_id": next(self.ids), "message": message}
+
+# === Один прогон (в отдельном процессе) ===
+def _cpu() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + kids.ru_utime + kids.ru_stime
+
+async def _run(args) -> dict:
+    from aiohttp import web
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder
+    from .config import init_dirs, cover_bytes
+    from .db import init_db, close_db
+    from .audd import client as audd_client
+    from .handlers import register_handlers
+    from .metrics import counters, snapshot
+    from .workers import shutdown_workers
+    from . import choices
+
+    init_dirs()
+    init_db()
+    cover_bytes()
+    media = make_media(Path(args.media_dir), args.media)
+
+    tg = TelegramStandIn(media, args.tg_latency)
+    audd = AuddStandIn(args.audd_latency)
+    runners = []
+    for app, port in ((tg.app(), args.port), (audd.app(), args.port + 1)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+    tg_url = f"http://127.0.0.1:{args.port}"
+    audd_client.url = f"http://127.0.0.1:{args.port + 1}/"
+    patch_youtube(f"{tg_url}/file/bot{BENCH_TOKEN}/media", args.media, args.yt_latency)
+
+    app = (
+        ApplicationBuilder()
+        .token(BENCH_TOKEN)
+        .base_url(f"{tg_url}/bot")
+        .base_file_url(f"{tg_url}/file/bot")
+        .concurrent_updates(args.concurrency)
+        .build()
+    )
+    register_handlers(app)
+
+    items = load_workload(Path(args.updates)) if args.updates else default_workload(args.count, args.media, args.seed)
+    make_update = UpdateFactory(tg)
+    limit = asyncio.Semaphore(args.concurrency)
+    pending: dict[int, asyncio.Task] = {}      # последняя задача пользователя: нажатие ждёт свою клавиатуру
+    done = failed = 0
+
+    async def feed(item: dict, previous: asyncio.Task | None):
+        nonlocal done, failed
+        if previous:
+            # нажатие ждёт, пока обработается поиск с его клавиатурой
+            await asyncio.gather(previous, return_exceptions=True)
+        data = make_update(item)
+        if data is None:
+            return
+        async with limit:
+            try:
+                await app.process_update(Update.de_json(data, app.bot))
+                done += 1
+            except Exception as e:
+                failed += 1
+                print(f"[bench] ❌ {e}", file=sys.stderr)
+
+    async with app:
+        sweeper = asyncio.ensure_future(choices.sweeper(app.bot))
+        await audd_client.start()
+        cpu0, t0 = _cpu(), time.perf_counter()
+
+        tasks = []
+        for item in items:
+            user = item.get("user", 1)
+            previous = pending.get(user) if item.get("type") == "tap" else None
+            pending[user] = task = asyncio.ensure_future(feed(item, previous))
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+
+        wall = time.perf_counter() - t0
+        cpu = _cpu() - cpu0
+        sweeper.cancel()
+        await audd_client.close()
+
+    for runner in runners:
+        await runner.cleanup()
+    shutdown_workers()
+    close_db()
+
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kids_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        "concurrency": args.concurrency, "updates": done, "failed": failed,
+        "wall": wall, "throughput": done / wall if wall else 0.0, "cpu": cpu,
+        "rss_mb": self_rss / 1024, "child_rss_mb": kids_rss / 1024,
+        "audd_requests": audd.requests, "tg_calls": tg.calls,
+        "stages": snapshot(), "counters": counters(),
+    }
+
+def _cmd_run(args):
+    result = asyncio.run(_run(args))
+    print(json.dumps(result))
+
+# === Несколько уровней параллельности ===
+def _hit_mix(values: dict[str, float]) -> str:
+    """Попадания/промахи по типу ключа: задержки без этой пропорции не сравнить."""
+    mix: dict[str, list[int]] = {}
+    for name, v in values.items():
+        if not name.startswith("cache_lookups{"):
+            continue
+        labels = dict(p.split("=", 1) for p in name[len("cache_lookups{"):-1].split(","))
+        hits_misses = mix.setdefault(labels["key"], [0, 0])
+        hits_misses[labels["result"] != "hit"] += int(v)
+    hits = sum(h for h, _ in mix.values())
+    total = hits + sum(m for _, m in mix.values())
+    parts = ", ".join(f"{key} {h}/{h + m}" for key, (h, m) in sorted(mix.items()))
+    ratio = f"{hits / total:.0%}" if total else "—"
+    return f"кэш: попаданий {hits} из {total} ({ratio}); по ключам: {parts or '—'}"
+
+def _print_report(results: list[dict]):
+    for r in results:
+        print(f"\n=== concurrency={r['concurrency']}: {r['updates']} апдейтов ({r['failed']} ошибок) "
+              f"за {r['wall']:.1f} сек → {r['throughput']:.2f}/сек, CPU {r['cpu']:.1f} сек, "
+              f"RSS {r['rss_mb']:.0f} МБ (ffmpeg до {r['child_rss_mb']:.0f} МБ), AUDD {r['audd_requests']} запросов")
+        print(_hit_mix(r["counters"]))
+        print(f"{'этап':32} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for name, s in r["stages"].items():
+            print(f"{name:32} {s['count']:6d} {s['p50']:8.3f} {s['p95']:8.3f} {s['p99']:8.3f}")
+
+def _cmd_levels(args):
+    results = []
+    for level in (int(x) for x in args.levels.split(",")):
+        with tempfile.TemporaryDirectory(prefix="bench_") as cache_dir:
+            env = dict(os.environ, CACHE_DIR=cache_dir, METRICS_PORT="0")
+            cmd = [sys.executable, "-m", "musicbot.bench", "run", "--concurrency", str(level)]
+            for key in ("updates", "count", "media", "seed", "media_dir", "port", "tg_latency", "audd_latency", "yt_latency"):
+                value = getattr(args, key)
+                if value is not None:
+                    cmd += [f"--{key.replace('_', '-')}", str(value)]
+            out = subprocess.run(cmd, env=env, capture_output=True, text=True)
+            if out.returncode:
+                print(out.stderr, file=sys.stderr)
+                sys.exit(out.returncode)
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    _print_report(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, ensure_ascii=False, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m musicbot.bench", description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("mode", nargs="?", default="levels", choices=("levels", "run"))
+    parser.add_argument("--levels", default="1,4,16", help="уровни параллельности через запятую")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--updates", help="JSONL с записанными апдейтами")
+    parser.add_argument("--count", type=int, default=40, help="размер синтетической нагрузки")
+    parser.add_argument("--media", type=int, default=8, help="сколько разных звуков")
+    parser.add_argument("--seed", type=int, default=1, help="зерно выбора звуков в синтетической нагрузке")
+    parser.add_argument("--media-dir", default=str(Path(tempfile.gettempdir()) / "musicbot_bench_media"))
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--tg-latency", type=float, default=0.05)
+    parser.add_argument("--audd-latency", type=float, default=1.0)
+    parser.add_argument("--yt-latency", type=float, default=0.5)
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    args = parser.parse_args()
+
+    Path(args.media_dir).mkdir(parents=True, exist_ok=True)
+    # настоящие токены не нужны: все запросы уходят на локальные заглушки
+    os.environ.setdefault("TG_BOT_TOKEN", BENCH_TOKEN)
+    os.environ.setdefault("AUDD_API_TOKEN", "bench")
+    if args.mode == "run":
+        _cmd_run(args)
+    else:
+        _cmd_levels(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import Dict
+from .config import MP3_DIR, MP3_CACHE_MAX_MB, MP3_CACHE_MAX_AGE_DAYS, log
+from .audd import purge_negative_cache
+from .search_cache import purge_search_cache
+from .locks import try_lock
+from .metrics import inc
+from .db import purge_choice_sessions, cache_files, touch_file, register_file, rename_file, delete_file_rows, youtube_ids
+from .fingerprint import forget_tracks, indexed_before
+
+MB = 1024 * 1024
+LOW_WATERMARK = 0.9            # чистим до 90% бюджета, чтобы не дёргаться на каждом файле
+HIT_BONUS = 24 * 3600          # каждая выдача «продлевает» файл на сутки (LRU + LFU)
+MAX_HIT_BONUS = 10
+PROTECT_RECENT = 10 * 60       # только что выданные файлы не трогаем: их может читать отправка
+
+# счётчики попаданий по типу ключа (url, audio_hash, title, ...)
+_lookups: Dict[str, Dict[str, int]] = {}
+
+def record_lookup(key_type: str, hit: bool):
+    stats = _lookups.setdefault(key_type, {"hits": 0, "misses": 0})
+    stats["hits" if hit else "misses"] += 1
+    inc("cache_lookups", key=key_type, result="hit" if hit else "miss")
+
+def hit_ratio() -> float:
+    hits = sum(s["hits"] for s in _lookups.values())
+    total = hits + sum(s["misses"] for s in _lookups.values())
+    return hits / total if total else 0.0
+
+def lookup_stats() -> Dict[str, Dict[str, int]]:
+    return {k: dict(v) for k, v in _lookups.items()}
+
+def _local(mp3_path: str) -> Path:
+    # в старых базах пути сохранены с обратными слэшами (Windows)
+    return Path(mp3_path.replace("\\", "/"))
+
+def is_deliverable(track: Dict) -> bool:
+    """Трек можно отправить: есть file_id в Telegram или файл на диске."""
+    if track.get("audio_file_id"):
+        return True
+    return bool(track.get("mp3_path")) and _local(track["mp3_path"]).exists()
+
+async def touch(mp3_path: str):
+    await touch_file(str(mp3_path), time.time())
+
+# байт mp3 на диске по последнему подсчёту: register() только прибавляет, полный
+# обход делает enforce_budget (None — ещё не считали)
+_total: int | None = None
+_budget_lock = asyncio.Lock()
+_evicting: asyncio.Task | None = None
+
+async def register(mp3_path: Path):
+    """Новый файл в кэше: записываем размер; выселение — в фоне и только сверх бюджета."""
+    global _total, _evicting
+    size = mp3_path.stat().st_size
+    await register_file(str(mp3_path), size, time.time())
+    if _total is not None:
+        _total += size
+        if _total <= MP3_CACHE_MAX_MB * MB:
+            return
+    if _evicting is None or _evicting.done():
+        _evicting = asyncio.ensure_future(enforce_budget())
+        _evicting.add_done_callback(_eviction_done)
+
+def _eviction_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        log.error(f"[Cache] ❌ Ошибка выселения: {task.exception()}")
+
+def _score(f: Dict) -> float:
+    # чем меньше — тем раньше выселяем
+    last = f["last_access"] or 0
+    score = last + min(f["hit_count"], MAX_HIT_BONUS) * HIT_BONUS
+    if f["has_file_id"]:
+        # такой трек Telegram отдаст по file_id и без локального файла
+        score -= 7 * 24 * 3600
+    return score
+
+def _on_disk(files: list[Dict]) -> list[Dict]:
+    """Строки, чей файл есть на диске, с путём и размером (stat на каждую — в потоке)."""
+    present = []
+    for f in files:
+        path = _local(f["mp3_path"])
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        f["path"] = path
+        f["size_bytes"] = f["size_bytes"] or st.st_size
+        present.append(f)
+    return present
+
+def _unlink(paths: list[Path]):
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+async def enforce_budget():
+    """Удаляет старые и редко запрашиваемые файлы, пока кэш не влезет в бюджет."""
+    global _total
+    async with _budget_lock:
+        now = time.time()
+        files = await asyncio.to_thread(_on_disk, await cache_files())
+
+        total = sum(f["size_bytes"] for f in files)
+        budget = MP3_CACHE_MAX_MB * MB
+        max_age = MP3_CACHE_MAX_AGE_DAYS * 24 * 3600
+        victims = []
+
+        for f in sorted(files, key=_score):
+            last = f["last_access"] or 0
+            if now - last < PROTECT_RECENT:
+                continue
+            too_old = now - last > max_age
+            if total <= budget * LOW_WATERMARK and not too_old:
+                continue
+            victims.append(f)
+            total -= f["size_bytes"]
+
+        await asyncio.to_thread(_unlink, [f["path"] for f in victims])
+        forgotten = []
+        for f in victims:
+            if not f["has_file_id"]:
+                # трек больше не выдать — и отпечаток ему не нужен (с file_id остаётся: Telegram отдаст)
+                await delete_file_rows(f["mp3_path"])
+                forgotten.append(f["youtube_id"])
+        await forget_tracks(forgotten)
+        _total = total
+
+    if victims:
+        freed = sum(f["size_bytes"] for f in victims)
+        log.info(f"[Cache] 🧹 Выселено {len(victims)} файлов ({freed / MB:.1f} МБ), в кэше {total / MB:.1f} МБ")
+
+def _check_paths(files: list[Dict]) -> list[tuple[Dict, Path, Path | None, int]]:
+    """(строка, путь в текущем формате, абсолютный путь или None — файла нет, размер)."""
+    checked = []
+    for f in files:
+        path = _local(f["mp3_path"])
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            checked.append((f, path, None, 0))
+            continue
+        checked.append((f, path, path.resolve(), size))
+    return checked
+
+def _remove_orphans(known: set[Path], older_than: float) -> int:
+    orphans = 0
+    for path in MP3_DIR.iterdir():
+        if not path.is_file() or path.resolve() in known:
+            continue
+        # свежие файлы могут докачиваться прямо сейчас
+        if path.stat().st_mtime < older_than:
+            path.unlink(missing_ok=True)
+            orphans += 1
+    return orphans
+
+async def reconcile():
+    """
+    Сверка диска и базы при старте:
+    - пути в старом формате переводятся в текущий;
+    - строки без файла и без file_id удаляются (битые ссылки);
+    - mp3 без строк в базе и недокачанные .part удаляются (сироты);
+    - отпечатки треков, которых нет в базе, удаляются из индекса.
+    Работа с диском — в потоке, чтобы не останавливать обработчики.
+    """
+    known = set()
+    dangling = 0
+    for f, path, resolved, size in await asyncio.to_thread(_check_paths, await cache_files()):
+        if str(path) != f["mp3_path"] and resolved:
+            await rename_file(f["mp3_path"], str(path))
+        if resolved:
+            known.add(resolved)
+            if not f["size_bytes"]:
+                await register_file(str(path), size, time.time())
+        elif not f["has_file_id"]:
+            await delete_file_rows(f["mp3_path"])
+            dangling += 1
+
+    orphans = await asyncio.to_thread(_remove_orphans, known, time.time() - 3600)
+
+    # трек индексируется в фоне раньше, чем попадает в базу, — свежие не трогаем
+    stale = await asyncio.to_thread(indexed_before, 3600) - await youtube_ids()
+    await forget_tracks(stale)
+
+    log.info(f"[Cache] 🔄 Сверка: {len(known)} файлов, удалено строк без файла {dangling}, файлов-сирот {orphans}, отпечатков {len(stale)}")
+
+async def is_maintainer(interval: float = 3600) -> bool:
+    """Общий кэш обслуживает один воркер — тот, кто держит аренду."""
+    return await try_lock("maintenance", interval * 1.5)
+
+async def maintenance_loop(interval: float = 3600):
+    """Раз в interval секунд выселяет устаревшие файлы и пишет статистику попаданий."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await is_maintainer(interval):
+                # в т.ч. файлы предзагрузки, которые так никто и не выбрал
+                await reconcile()
+                await enforce_budget()
+                await purge_negative_cache()
+                await purge_search_cache()
+                await purge_choice_sessions(time.time())
+        except Exception as e:
+            log.error(f"[Cache] ❌ Ошибка обслуживания кэша: {e}")
+        log.info(f"[Cache] 📊 Попадания: {hit_ratio():.0%} {lookup_stats()}")
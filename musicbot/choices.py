@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import json
+import secrets
+import time
+from dataclasses import dataclass, field
+from typing import Dict
+from telegram import Bot
+from .config import CHOICE_TTL, WORKER_ID, log
+from .db import (
+    save_choice_session, delete_choice_session, load_choice_sessions, load_expired_choice_sessions,
+    get_choice_session,
+)
+from .prefetch import release
+
+@dataclass(slots=True, frozen=True)
+class Candidate:
+    id: str
+    title: str
+    duration: int
+
+@dataclass(slots=True)
+class Session:
+    sid: str
+    user_id: int
+    chat_id: int
+    candidates: tuple[Candidate, ...]
+    expires_at: float
+    query: str = ""
+    message_id: int | None = None
+    prefetch: Dict[str, asyncio.Task] = field(default_factory=dict)
+
+# sid -> сессия, user_id -> sid его последней клавиатуры, куча (expires_at, sid) для уборщика
+_sessions: Dict[str, Session] = {}
+_by_user: Dict[int, str] = {}
+_expiry: list[tuple[float, str]] = []
+_wakeup = asyncio.Event()
+
+def candidate(entry: dict) -> Candidate:
+    """Из записи yt-dlp оставляем только то, что нужно кнопкам и загрузке."""
+    return Candidate(
+        id=entry.get("id") or "",
+        title=entry.get("title") or "Без названия",
+        duration=int(float(entry.get("duration") or 0)),
+    )
+
+def callback_data(sid: str, index: int) -> str:
+    return f"c:{sid}:{index}"
+
+def parse_callback(data: str) -> tuple[str, int] | None:
+    parts = data.split(":")
+    if len(parts) != 3 or parts[0] != "c" or not parts[2].isdigit():
+        return None
+    return parts[1], int(parts[2])
+
+async def open_session(user_id: int, chat_id: int, entries: list[dict], query: str = "") -> tuple[Session, Session | None]:
+    """
+    Новая клавиатура пользователя. Возвращает её и предыдущую сессию того же
+    пользователя (она закрыта — её сообщение вызывающий может удалить).
+    """
+    previous = None
+    if old_sid := _by_user.get(user_id):
+        previous = await close(old_sid)
+
+    session = Session(
+        sid=secrets.token_urlsafe(6),
+        user_id=user_id,
+        chat_id=chat_id,
+        candidates=tuple(candidate(e) for e in entries),
+        expires_at=time.time() + CHOICE_TTL,
+        query=query,
+    )
+    _add(session)
+    return session, previous
+
+def _add(session: Session):
+    _sessions[session.sid] = session
+    _by_user[session.user_id] = session.sid
+    heapq.heappush(_expiry, (session.expires_at, session.sid))
+    _wakeup.set()
+
+async def attach_message(session: Session, message_id: int):
+    session.message_id = message_id
+    await save_choice_session(
+        session.sid, WORKER_ID, session.user_id, session.chat_id, message_id,
+        json.dumps([[c.id, c.title, c.duration] for c in session.candidates], ensure_ascii=False),
+        session.expires_at,
+        session.query,
+    )
+
+def _from_row(row: tuple) -> Session:
+    sid, user_id, chat_id, message_id, candidates, expires_at, query = row
+    return Session(
+        sid=sid,
+        user_id=user_id,
+        chat_id=chat_id,
+        candidates=tuple(Candidate(*c) for c in json.loads(candidates)),
+        expires_at=expires_at,
+        query=query or "",
+        message_id=message_id,
+    )
+
+async def get(sid: str) -> Session | None:
+    """Сессия этого воркера из памяти, чужая (кнопку принял другой воркер) — из базы."""
+    session = _sessions.get(sid)
+    if session is None and (row := await get_choice_session(sid)):
+        session = _from_row(row)
+    if session and session.expires_at < time.time():
+        return None
+    return session
+
+async def close(sid: str) -> Session | None:
+    session = _sessions.pop(sid, None)
+    if session is None:
+        return None
+    if _by_user.get(session.user_id) == sid:
+        del _by_user[session.user_id]
+    release(session.prefetch)
+    await delete_choice_session(sid)
+    return session
+
+async def _expire(bot: Bot, session: Session):
+    if session.message_id is None:
+        return
+    try:
+        await bot.delete_message(chat_id=session.chat_id, message_id=session.message_id)
+    except Exception:
+        pass
+
+async def _adopt(now: float):
+    """Истёкшие клавиатуры чужих воркеров — в свою кучу, чтобы их сообщения тоже удалились."""
+    # свой воркер закрывает клавиатуру в срок — чужие ждём ещё CHOICE_TTL, чтобы не удалять дважды
+    for row in await load_expired_choice_sessions(WORKER_ID, now - CHOICE_TTL):
+        session = _from_row(row)
+        if session.sid in _sessions:
+            continue
+        # без _by_user: у пользователя может быть своя живая клавиатура на этом воркере
+        _sessions[session.sid] = session
+        heapq.heappush(_expiry, (session.expires_at, session.sid))
+
+async def sweeper(bot: Bot):
+    """
+    Одна задача на все клавиатуры: спит до ближайшего срока, закрывает истёкшие.
+    Раз в CHOICE_TTL подбирает истёкшие клавиатуры воркеров, которые не вернулись.
+    """
+    adopt_at = 0.0
+    while True:
+        now = time.time()
+        if now >= adopt_at:
+            adopt_at = now + CHOICE_TTL
+            try:
+                await _adopt(now)
+            except Exception as e:
+                log.error(f"[Choices] ❌ Не удалось подобрать чужие клавиатуры: {e}")
+        while _expiry and _expiry[0][0] <= now:
+            _, sid = heapq.heappop(_expiry)
+            session = _sessions.get(sid)
+            # сессия могла уже закрыться или смениться
+            if session is None or session.expires_at > now:
+                continue
+            try:
+                await close(sid)
+                await _expire(bot, session)
+            except Exception as e:
+                # сбой базы на одной сессии не должен останавливать уборку остальных
+                log.error(f"[Choices] ❌ Не удалось закрыть клавиатуру {sid}: {e}")
+
+        timeout = min(_expiry[0][0], adopt_at) - now if _expiry else adopt_at - now
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def restore():
+    """Поднимает из базы клавиатуры этого воркера, пережившие рестарт (истёкшие уберёт sweeper)."""
+    rows = await load_choice_sessions(WORKER_ID)
+    for row in rows:
+        _add(_from_row(row))
+    if rows:
+        log.info(f"[Choices] 🔄 Восстановлено клавиатур: {len(rows)}")
+
+def choice_stats() -> Dict[str, int]:
+    return {"sessions": len(_sessions), "heap": len(_expiry)}
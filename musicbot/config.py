@@ -1,5 +1,7 @@
 import os
 import logging
+import socket
+from functools import cache
 from pathlib import Path
 
 # env
@@ -9,16 +11,119 @@ if not TG_TOKEN or not AUDD_TOKEN:
     raise RuntimeError("❌ Укажи TG_BOT_TOKEN и AUDD_API_TOKEN в .env")
 
 # paths
-CACHE_DIR = Path("cache")
+# общий для всех воркеров каталог — только локальный диск одного хоста: базы в режиме WAL
+# (cache.db, fingerprints.db) на сетевой ФС (NFS, SMB, общий том) портятся или виснут
+CACHE_DIR = Path(os.environ.get("CACHE_DIR", "cache"))
 MP3_DIR = CACHE_DIR / "mp3"
 DB_PATH = CACHE_DIR / "cache.db"
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+COVER_PATH = Path("assets/logo1.jpg")
+FP_DB_PATH = CACHE_DIR / "fingerprints.db"
 
 FFMPEG = "ffmpeg"
 
+# локальные аудио-отпечатки: минимум совпавших хэшей и доля от хэшей запроса
+FP_MIN_MATCHES = int(os.environ.get("FP_MIN_MATCHES", "12"))
+FP_MIN_CONFIDENCE = float(os.environ.get("FP_MIN_CONFIDENCE", "0.02"))
+
+# метрики: порт /metrics и /healthz на localhost (0 — выключен) и кто видит /stats
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").replace(",", " ").split()}
+
+# несколько воркеров — только на одном хосте с общим локальным CACHE_DIR: ключи, треки,
+# клавиатуры и отпечатки живут в SQLite, в Redis (LOCK_BACKEND=redis) выносятся лишь аренды.
+# Имя воркера постоянно между рестартами — по нему он поднимает свои клавиатуры; каждому
+# воркеру задай свой WORKER_ID. Несколько воркеров — только в режиме webhook:
+# long polling одновременно из двух процессов Telegram отклоняет (409 Conflict).
+WORKER_ID = os.environ.get("WORKER_ID") or socket.gethostname()
+LOCK_BACKEND = os.environ.get("LOCK_BACKEND", "sqlite")
+LOCK_TTL = float(os.environ.get("LOCK_TTL", "60"))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# webhook вместо long polling, если задан публичный адрес (например, https://bot.example.com)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    # без секрета апдейты на публичный адрес мог бы слать кто угодно
+    raise RuntimeError("❌ Для webhook укажи WEBHOOK_SECRET (A-Z, a-z, 0-9, _ и -, до 256 символов)")
+# сколько апдейтов обрабатывается одновременно (0 — по лимитам планировщика)
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "0"))
+
+# планировщик: одновременных запросов, длина очереди и лимиты тяжёлых этапов
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "6"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "50"))
+FFMPEG_CONCURRENCY = int(os.environ.get("FFMPEG_CONCURRENCY", str(os.cpu_count() or 2)))
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "3"))
+
+# пакетный режим (несколько ссылок или плейлист): предел ссылок, одновременно у пользователя,
+# как часто обновлять сообщение с прогрессом (Telegram ограничивает частоту правок)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "25"))
+BATCH_USER_CONCURRENCY = int(os.environ.get("BATCH_USER_CONCURRENCY", "3"))
+BATCH_PROGRESS_INTERVAL = float(os.environ.get("BATCH_PROGRESS_INTERVAL", "2"))
+
+# inline-режим (@bot название): размер страницы, сколько Telegram и мы кэшируем ответ,
+# через сколько секунд после последнего набора качать ненайденное и с какой длины запроса
+INLINE_PAGE_SIZE = int(os.environ.get("INLINE_PAGE_SIZE", "20"))
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "60"))
+INLINE_RESULT_TTL = float(os.environ.get("INLINE_RESULT_TTL", "30"))
+INLINE_RESULT_CACHE_SIZE = int(os.environ.get("INLINE_RESULT_CACHE_SIZE", "1024"))
+INLINE_FETCH_DELAY = float(os.environ.get("INLINE_FETCH_DELAY", "1.5"))
+INLINE_FETCH_MIN_CHARS = int(os.environ.get("INLINE_FETCH_MIN_CHARS", "4"))
+# служебный чат/канал, куда бот загружает скачанное ради file_id (0 — inline не качает ненайденное:
+# без file_id трек в inline-выдачу всё равно не попадёт)
+INLINE_STORAGE_CHAT_ID = int(os.environ.get("INLINE_STORAGE_CHAT_ID", "0"))
+
+# сколько секунд живёт клавиатура выбора трека
+CHOICE_TTL = int(os.environ.get("CHOICE_TTL", "60"))
+
+# предзагрузка лучших кандидатов поиска, пока пользователь выбирает
+PREFETCH_CANDIDATES = int(os.environ.get("PREFETCH_CANDIDATES", "1"))
+PREFETCH_MAX = int(os.environ.get("PREFETCH_MAX", "2"))
+
+# сколько лучших окон звука можно отправить в AUDD; следующее окно уходит, только если
+# предыдущее не распознано или не ответило за AUDD_HEDGE_DELAY секунд
+RECOGNITION_WINDOWS = int(os.environ.get("RECOGNITION_WINDOWS", "2"))
+AUDD_HEDGE_DELAY = float(os.environ.get("AUDD_HEDGE_DELAY", "4"))
+
+# бюджет mp3-кэша на диске
+MP3_CACHE_MAX_MB = int(os.environ.get("MP3_CACHE_MAX_MB", "2048"))
+MP3_CACHE_MAX_AGE_DAYS = int(os.environ.get("MP3_CACHE_MAX_AGE_DAYS", "90"))
+
+# клиент AUDD: одна keep-alive сессия, лимит параллельных запросов, повторы на 5xx/таймаутах
+AUDD_URL = os.environ.get("AUDD_URL", "https://api.audd.io/")
+AUDD_CONCURRENCY = int(os.environ.get("AUDD_CONCURRENCY", "4"))
+AUDD_RETRIES = int(os.environ.get("AUDD_RETRIES", "2"))
+AUDD_TIMEOUT = float(os.environ.get("AUDD_TIMEOUT", "20"))
+# доп. метаданные в ответе (внешние id, длительность)
+AUDD_RETURN = os.environ.get("AUDD_RETURN", "spotify,apple_music,musicbrainz")
+# «не распознано» помним столько секунд, успешные результаты — бессрочно
+AUDD_NEGATIVE_TTL = float(os.environ.get("AUDD_NEGATIVE_TTL", str(6 * 3600)))
+
+# кэш поиска YouTube: свежесть, предел устаревания и размер LRU в памяти
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", str(6 * 3600)))
+SEARCH_CACHE_MAX_STALE = float(os.environ.get("SEARCH_CACHE_MAX_STALE", str(7 * 24 * 3600)))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "512"))
+
+# пул потоков для блокирующих вызовов yt-dlp
+YTDLP_WORKERS = int(os.environ.get("YTDLP_WORKERS", "4"))
+YTDLP_SEARCH_TIMEOUT = float(os.environ.get("YTDLP_SEARCH_TIMEOUT", "30"))
+YTDLP_DOWNLOAD_TIMEOUT = float(os.environ.get("YTDLP_DOWNLOAD_TIMEOUT", "300"))
+
 # logging
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("HybridMusicBot")
 
 def init_dirs():
-    CACHE_DIR.mkdir(exist_ok=True)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
     MP3_DIR.mkdir(exist_ok=True)
+
+@cache
+def cover_bytes() -> bytes | None:
+    """Обложка читается с диска один раз за время работы; нет файла — треки без обложки."""
+    try:
+        return COVER_PATH.read_bytes()
+    except OSError as e:
+        log.warning(f"[Cover] ⚠ Обложка {COVER_PATH} недоступна ({e}) — mp3 будут без неё")
+        return None
@@ -1,77 +1,532 @@
+import asyncio
+import re
 import sqlite3
-from typing import Optional, Dict
-from .config import DB_PATH
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Dict
+from .config import DB_PATH, DB_MMAP_SIZE, log
 import unicodedata
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+
+# Одно долгоживущее соединение, которым владеет выделенный поток.
+# Все запросы идут через него: нет затрат на connect и event loop не блокируется.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+_conn: sqlite3.Connection | None = None
+
+# Записи копятся здесь и коммитятся пачкой в одной транзакции
+_pending: list[tuple[str, tuple, Future]] = []
+_pending_lock = threading.Lock()
+
+def _open() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        check_same_thread=False,
+        isolation_level=None,       # транзакциями управляем сами (BEGIN/COMMIT)
+        cached_statements=256,      # подготовленные запросы переиспользуются по тексту SQL
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA foreign_keys=ON")    # ключи удаляются вместе с треком
+    return conn
+
+def _get_conn() -> sqlite3.Connection:
+    # вызывается только из потока _executor
+    global _conn
+    if _conn is None:
+        _conn = _open()
+    return _conn
+
+async def _run(fn: Callable[[sqlite3.Connection], Any]) -> Any:
+    """Выполняет fn(conn) в потоке БД. Порядок вызовов сохраняется (один поток)."""
+    return await asyncio.wrap_future(_executor.submit(lambda: fn(_get_conn())))
+
+async def _fetchone(sql: str, params: tuple = ()) -> Optional[tuple]:
+    return await _run(lambda c: c.execute(sql, params).fetchone())
+
+async def _fetchall(sql: str, params: tuple = ()) -> list:
+    return await _run(lambda c: c.execute(sql, params).fetchall())
+
+def _flush():
+    with _pending_lock:
+        batch = _pending[:]
+        _pending.clear()
+    if not batch:
+        return
+
+    conn = _get_conn()
+    results = []
+    try:
+        conn.execute("BEGIN IMMEDIATE")     # сразу берём блокировку записи: базу могут делить несколько воркеров
+        for sql, params, _ in batch:
+            try:
+                results.append(conn.execute(sql, params).rowcount)
+            except Exception as e:
+                # ошибка одного запроса откатывает только его
+                results.append(e)
+        conn.execute("COMMIT")
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        for _, _, fut in batch:
+            fut.set_exception(e)
+        return
+
+    for (_, _, fut), res in zip(batch, results):
+        if isinstance(res, Exception):
+            fut.set_exception(res)
+        else:
+            fut.set_result(res)
+
+async def _write(sql: str, params: tuple = ()) -> int:
+    """
+    Ставит запись в очередь. Все записи, накопившиеся пока поток БД занят,
+    коммитятся одной транзакцией. Чтение, вызванное после await, видит запись.
+    """
+    fut: Future = Future()
+    with _pending_lock:
+        _pending.append((sql, params, fut))
+        schedule = len(_pending) == 1
+    if schedule:
+        _executor.submit(_flush)
+    return await asyncio.wrap_future(fut)
+
+# === Схема и миграции ===
+# Каждая миграция выполняется один раз в своей транзакции (BEGIN IMMEDIATE),
+# номер применённой записывается в schema_version. Несколько воркеров могут
+# стартовать одновременно: второй дождётся блокировки и увидит, что шаг уже сделан.
+
+def _m1_base(cur):
+    """Служебные таблицы (в старых базах уже есть — только недостающие колонки)."""
+    # ответы AUDD по хэшу фрагмента; result NULL — «не распознано»
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS recognitions (
+            audio_hash TEXT PRIMARY KEY,
+            result TEXT,
+            created_at REAL NOT NULL
+        )
+    """)
+    # результаты поиска YouTube по нормализованному запросу (JSON)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS search_cache (
+            key TEXT PRIMARY KEY,
+            results TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    # открытые клавиатуры выбора трека (переживают рестарт)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS choice_sessions (
+            sid TEXT PRIMARY KEY,
+            worker TEXT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER,
+            candidates TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            query TEXT
+        )
+    """)
+    _ensure_columns(cur, "choice_sessions", {"worker": "TEXT", "query": "TEXT"})
+    # аренды межпроцессных блокировок (musicbot.locks, бэкенд sqlite)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS locks (
+            key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+
+# Ключи поиска трека: каждый ведёт ровно на одну строку tracks
+KEY_TABLES = {
+    "url": "track_urls",        # ссылка, присланная пользователем
+    "audio": "track_hashes",    # хэш PCM фрагмента (musicbot.audio.content_hash)
+    "video": "track_videos",    # file_unique_id видео из Telegram
+    "query": "track_queries",   # нормализованный текстовый запрос
+}
+
+def _m2_tracks(cur):
+    """
+    Одна строка на трек (youtube_id UNIQUE), ключи поиска — в отдельных таблицах.
+    Старая tracks (строка на каждый запрос, а в базах от прежнего cache_db.py — с TEXT id)
+    переименовывается, сливается по youtube_id и удаляется.
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tracks'")
+    legacy = cur.fetchone() is not None
+    if legacy:
+        for trigger in ("tracks_fts_ai", "tracks_fts_ad", "tracks_fts_au"):
+            cur.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cur.execute("DROP TABLE IF EXISTS tracks_fts")
+        for index in ("idx_audio_hash", "idx_url", "idx_mp3_path", "idx_youtube_id"):
+            cur.execute(f"DROP INDEX IF EXISTS {index}")
+        cur.execute("ALTER TABLE tracks RENAME TO tracks_legacy")
+
     cur.execute("""
-        CREATE TABLE IF NOT EXISTS tracks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            file_id TEXT,
-            url TEXT,
-            source_url TEXT, 
-            audio_hash TEXT,
+        CREATE TABLE tracks (
+            id INTEGER PRIMARY KEY,
+            youtube_id TEXT NOT NULL UNIQUE,
             artist TEXT,
             title TEXT,
             mp3_path TEXT,
-            youtube_id TEXT,
+            audio_file_id TEXT,
+            thumb_file_id TEXT,
+            size_bytes INTEGER,
+            last_access REAL,
+            hit_count INTEGER NOT NULL DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_audio_hash ON tracks(audio_hash)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_url ON tracks(url)")
-    conn.commit()
-    conn.close()
-
-def get_by_file_id(fid: str) -> Optional[Dict]:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT artist, title, mp3_path FROM tracks WHERE file_id=?", (fid,))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None
-    return {"artist": row[0], "title": row[1], "mp3_path": row[2]}
-
-def get_by_audio_hash(ahash: str) -> Optional[Dict]:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT artist, title, mp3_path FROM tracks WHERE audio_hash=?", (ahash,))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None
-    return {"artist": row[0], "title": row[1], "mp3_path": row[2]}
+    cur.execute("CREATE INDEX idx_tracks_mp3_path ON tracks(mp3_path)")
+    for table in KEY_TABLES.values():
+        cur.execute(f"""
+            CREATE TABLE {table} (
+                key TEXT PRIMARY KEY,
+                track_id INTEGER NOT NULL REFERENCES tracks(id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+        """)
+        # для каскадного удаления ключей вместе с треком
+        cur.execute(f"CREATE INDEX idx_{table}_track ON {table}(track_id)")
+
+    if legacy:
+        _import_legacy(cur)
+        cur.execute("DROP TABLE tracks_legacy")
+    _init_fts(cur)
+
+def _m3_popular(cur):
+    """Индекс популярных треков с file_id (пустой inline-запрос)."""
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tracks_popular ON tracks(hit_count DESC)
+        WHERE audio_file_id IS NOT NULL
+    """)
+
+_MIGRATIONS = (_m1_base, _m2_tracks, _m3_popular)
 
-def save_track(fid: str, ahash: str, artist: str, title: str, mp3_path: str, youtube_id: str):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+def _migrate(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at REAL NOT NULL
+        )
+    """)
+    for version, step in enumerate(_MIGRATIONS, start=1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not conn.execute("SELECT 1 FROM schema_version WHERE version=?", (version,)).fetchone():
+                step(conn.cursor())
+                conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (version, time.time()))
+                log.info(f"[DB] 🔧 Миграция {version}: {step.__doc__.strip().splitlines()[0]}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+_VID_IN_PATH = re.compile(r"\[([\w-]{11})\]\.mp3$")
+
+def _import_legacy(cur):
+    """
+    Переносит строки старой tracks: по одной на youtube_id (у старых строк без
+    youtube_id он берётся из имени файла «... [id].mp3»), url и хэши — в ключи.
+    """
+    cur.execute("PRAGMA table_info(tracks_legacy)")
+    have = {row[1] for row in cur.fetchall()}
+    fields = ("youtube_id", "artist", "title", "mp3_path", "audio_file_id", "thumb_file_id",
+              "size_bytes", "last_access", "hit_count", "created_at", "url", "audio_hash")
+    columns = ", ".join(f if f in have else "NULL" for f in fields)
+    # от новых строк к старым: у новых актуальнее путь и метаданные
+    cur.execute(f"SELECT {columns} FROM tracks_legacy ORDER BY rowid DESC")
+
+    tracks: Dict[str, Dict] = {}
+    keys: list[tuple[str, str, str]] = []
+    skipped = 0
+    for values in cur.fetchall():
+        row = dict(zip(fields, values))
+        vid = row["youtube_id"] or (
+            (m := _VID_IN_PATH.search((row["mp3_path"] or "").replace("\\", "/"))) and m.group(1)
+        )
+        if not vid:
+            skipped += 1
+            continue
+        if row["url"]:
+            keys.append(("url", row["url"], vid))
+        if row["audio_hash"]:
+            keys.append(("audio", row["audio_hash"], vid))
+
+        t = tracks.get(vid)
+        if t is None:
+            tracks[vid] = dict(row, youtube_id=vid)
+            continue
+        # дубликаты: метаданные AUDD лучше «Unknown» из ручного выбора, file_id — из любой строки
+        if t["artist"] in (None, "Unknown") and row["artist"] not in (None, "Unknown"):
+            t["artist"], t["title"] = row["artist"], row["title"]
+        if not t["audio_file_id"] and row["audio_file_id"]:
+            t["audio_file_id"], t["thumb_file_id"] = row["audio_file_id"], row["thumb_file_id"]
+        t["mp3_path"] = t["mp3_path"] or row["mp3_path"]
+        t["size_bytes"] = t["size_bytes"] or row["size_bytes"]
+        t["last_access"] = max(t["last_access"] or 0, row["last_access"] or 0) or None
+        t["hit_count"] = max(t["hit_count"] or 0, row["hit_count"] or 0)
+        t["created_at"] = min(filter(None, (t["created_at"], row["created_at"])), default=None)
+
+    cur.executemany("""
+        INSERT INTO tracks (youtube_id, artist, title, mp3_path, audio_file_id, thumb_file_id,
+                            size_bytes, last_access, hit_count, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+    """, [
+        (t["youtube_id"], t["artist"], t["title"], t["mp3_path"], t["audio_file_id"], t["thumb_file_id"],
+         t["size_bytes"], t["last_access"], t["hit_count"] or 0, t["created_at"])
+        for t in tracks.values()
+    ])
+    for kind, key, vid in keys:
+        # ключ, встреченный первым (в самой новой строке), побеждает
+        cur.execute(f"""
+            INSERT OR IGNORE INTO {KEY_TABLES[kind]} (key, track_id)
+            SELECT ?, id FROM tracks WHERE youtube_id=?
+        """, (key, vid))
+    log.info(f"[DB] 📥 Импорт старой tracks: треков {len(tracks)}, ключей {len(keys)}, без youtube_id пропущено {skipped}")
+
+def _init_fts(cur):
+    """
+    Полнотекстовый индекс по title/artist. unicode61 с remove_diacritics
+    даёт регистро- и акцентонезависимый поиск без normalize() в Python.
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name='tracks_fts'")
+    exists = cur.fetchone() is not None
+
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+            title, artist,
+            content='tracks', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    """)
+    # синхронизация с tracks на save_track
     cur.execute("""
-        INSERT OR REPLACE INTO tracks (file_id, audio_hash, artist, title, mp3_path, youtube_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (fid, ahash, artist, title, mp3_path, youtube_id))
-    conn.commit()
-    conn.close()
-def get_by_url(url: str):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT artist, title, mp3_path FROM tracks WHERE url=?", (url,))
-    row = cur.fetchone()
-    conn.close()
+        CREATE TRIGGER IF NOT EXISTS tracks_fts_ai AFTER INSERT ON tracks BEGIN
+            INSERT INTO tracks_fts(rowid, title, artist) VALUES (new.id, new.title, new.artist);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS tracks_fts_ad AFTER DELETE ON tracks BEGIN
+            INSERT INTO tracks_fts(tracks_fts, rowid, title, artist) VALUES ('delete', old.id, old.title, old.artist);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS tracks_fts_au AFTER UPDATE OF title, artist ON tracks BEGIN
+            INSERT INTO tracks_fts(tracks_fts, rowid, title, artist) VALUES ('delete', old.id, old.title, old.artist);
+            INSERT INTO tracks_fts(rowid, title, artist) VALUES (new.id, new.title, new.artist);
+        END
+    """)
+
+    if not exists:
+        # старая база: индексируем уже накопленные строки
+        cur.execute("INSERT INTO tracks_fts(tracks_fts) VALUES ('rebuild')")
+
+def init_db():
+    _executor.submit(lambda: _migrate(_get_conn())).result()
+    log.info(f"[DB] 🗄 {DB_PATH} открыта (WAL)")
+
+def close_db():
+    """Дописывает очередь записей и закрывает соединение."""
+    def _close():
+        global _conn
+        _flush()
+        if _conn is not None:
+            _conn.execute("PRAGMA optimize")
+            _conn.close()
+            _conn = None
+    _executor.submit(_close).result()
+
+def _ensure_columns(cur, table: str, columns: Dict[str, str]):
+    """Добавляет недостающие колонки в уже существующую таблицу (старые базы)."""
+    cur.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cur.fetchall()}
+    for name, decl in columns.items():
+        if name not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+_TRACK = "t.artist, t.title, t.mp3_path, t.youtube_id, t.audio_file_id"
+
+def _track(row: Optional[tuple]) -> Optional[Dict]:
     if not row:
         return None
-    return {"artist": row[0], "title": row[1], "mp3_path": row[2]}
+    return {"artist": row[0], "title": row[1], "mp3_path": row[2], "youtube_id": row[3], "audio_file_id": row[4]}
+
+def query_key(query: str) -> str:
+    """Текстовый запрос без регистра, диакритики и пунктуации."""
+    return " ".join(tokens(query))
+
+async def _get_by_key(kind: str, key: str) -> Optional[Dict]:
+    return _track(await _fetchone(f"""
+        SELECT {_TRACK} FROM {KEY_TABLES[kind]} k JOIN tracks t ON t.id = k.track_id WHERE k.key=?
+    """, (key,)))
+
+async def get_by_url(url: str) -> Optional[Dict]:
+    return await _get_by_key("url", url)
+
+async def get_by_audio_hash(ahash: str) -> Optional[Dict]:
+    return await _get_by_key("audio", ahash)
+
+async def get_by_video(file_unique_id: str) -> Optional[Dict]:
+    return await _get_by_key("video", file_unique_id)
+
+async def get_by_query(query: str) -> Optional[Dict]:
+    key = query_key(query)
+    return await _get_by_key("query", key) if key else None
+
+async def get_by_youtube_id(vid: str) -> Optional[Dict]:
+    return _track(await _fetchone(f"SELECT {_TRACK} FROM tracks t WHERE t.youtube_id=?", (vid,)))
+
+async def save_track(youtube_id: str, artist: str, title: str, mp3_path: str, *,
+                     url: str | None = None, ahash: str | None = None,
+                     video: str | None = None, query: str | None = None):
+    """
+    Трек (одна строка на youtube_id) и ключи, по которым его найти в следующий раз.
+    Повторное сохранение того же трека ничего не добавляет: строка обновляется на месте.
+    """
+    await _write("""
+        INSERT INTO tracks (youtube_id, artist, title, mp3_path) VALUES (?, ?, ?, ?)
+        ON CONFLICT(youtube_id) DO UPDATE SET
+            mp3_path=excluded.mp3_path,
+            -- название от AUDD не затираем «Unknown» из ручного выбора
+            artist=CASE WHEN tracks.artist IS NULL OR tracks.artist='Unknown' THEN excluded.artist ELSE tracks.artist END,
+            title=CASE WHEN tracks.artist IS NULL OR tracks.artist='Unknown' THEN excluded.title ELSE tracks.title END
+    """, (youtube_id, artist, title, mp3_path))
+
+    keys = {"url": url, "audio": ahash, "video": video, "query": query_key(query) if query else None}
+    for kind, key in keys.items():
+        if not key:
+            continue
+        table = KEY_TABLES[kind]
+        await _write(f"""
+            INSERT INTO {table} (key, track_id) SELECT ?, id FROM tracks WHERE youtube_id=?
+            ON CONFLICT(key) DO UPDATE SET track_id=excluded.track_id WHERE {table}.track_id != excluded.track_id
+        """, (key, youtube_id))
+
+async def get_audio_file_id(mp3_path: str) -> Optional[str]:
+    """Telegram file_id уже отправленного mp3 (если он когда-либо загружался)."""
+    row = await _fetchone("""
+        SELECT audio_file_id FROM tracks
+        WHERE mp3_path=? AND audio_file_id IS NOT NULL
+        LIMIT 1
+    """, (mp3_path,))
+    return row[0] if row else None
+
+async def save_audio_file_id(mp3_path: str, audio_fid: Optional[str], thumb_fid: Optional[str]):
+    """Запоминает file_id аудио и обложки трека с этим mp3."""
+    await _write("""
+        UPDATE tracks SET audio_file_id=?, thumb_file_id=? WHERE mp3_path=?
+    """, (audio_fid, thumb_fid, mp3_path))
+
+# === Кэш ответов AUDD ===
+async def get_recognition(ahash: str) -> Optional[tuple[Optional[str], float]]:
+    """(result JSON или None для отрицательного ответа, время записи)."""
+    return await _fetchone("SELECT result, created_at FROM recognitions WHERE audio_hash=?", (ahash,))
+
+async def save_recognition(ahash: str, result: Optional[str], now: float):
+    await _write("""
+        INSERT OR REPLACE INTO recognitions (audio_hash, result, created_at) VALUES (?, ?, ?)
+    """, (ahash, result, now))
+
+async def purge_negative_recognitions(before: float) -> int:
+    return await _write("DELETE FROM recognitions WHERE result IS NULL AND created_at < ?", (before,))
+
+# === Кэш поиска YouTube ===
+async def get_search(key: str) -> Optional[tuple[str, float]]:
+    return await _fetchone("SELECT results, created_at FROM search_cache WHERE key=?", (key,))
+
+async def save_search(key: str, results: str, now: float):
+    await _write("""
+        INSERT OR REPLACE INTO search_cache (key, results, created_at) VALUES (?, ?, ?)
+    """, (key, results, now))
+
+async def purge_searches(before: float) -> int:
+    return await _write("DELETE FROM search_cache WHERE created_at < ?", (before,))
+
+# === Клавиатуры выбора ===
+async def save_choice_session(sid: str, worker: str, user_id: int, chat_id: int, message_id: int,
+                              candidates: str, expires_at: float, query: str):
+    await _write("""
+        INSERT OR REPLACE INTO choice_sessions (sid, worker, user_id, chat_id, message_id, candidates, expires_at, query)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (sid, worker, user_id, chat_id, message_id, candidates, expires_at, query))
+
+async def delete_choice_session(sid: str):
+    await _write("DELETE FROM choice_sessions WHERE sid=?", (sid,))
+
+async def purge_choice_sessions(before: float) -> int:
+    """Истёкшие сессии воркеров, которые так и не вернулись."""
+    return await _write("DELETE FROM choice_sessions WHERE expires_at < ?", (before,))
+
+async def get_choice_session(sid: str) -> Optional[tuple]:
+    return await _fetchone("""
+        SELECT sid, user_id, chat_id, message_id, candidates, expires_at, query FROM choice_sessions WHERE sid=?
+    """, (sid,))
+
+async def load_choice_sessions(worker: str) -> list[tuple]:
+    # строки без worker — из однопроцессной версии, их поднимает любой
+    return await _fetchall("""
+        SELECT sid, user_id, chat_id, message_id, candidates, expires_at, query FROM choice_sessions
+        WHERE worker=? OR worker IS NULL
+    """, (worker,))
+
+async def load_expired_choice_sessions(worker: str, before: float) -> list[tuple]:
+    """Истёкшие клавиатуры других воркеров (их воркер мог не вернуться после рестарта)."""
+    return await _fetchall("""
+        SELECT sid, user_id, chat_id, message_id, candidates, expires_at, query FROM choice_sessions
+        WHERE expires_at < ? AND worker IS NOT ?
+    """, (before, worker))
+
+# === Межпроцессные аренды ===
+async def try_lease(key: str, owner: str, now: float, ttl: float) -> bool:
+    """Одним запросом: берёт свободный/просроченный ключ или продлевает свой."""
+    return await _write("""
+        INSERT INTO locks (key, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+        WHERE locks.owner = excluded.owner OR locks.expires_at < ?
+    """, (key, owner, now + ttl, now)) > 0
+
+async def drop_lease(key: str, owner: str):
+    await _write("DELETE FROM locks WHERE key=? AND owner=?", (key, owner))
+
+# === Учёт файлов mp3-кэша (размер, последний доступ, число выдач) ===
+async def touch_file(mp3_path: str, now: float):
+    """Трек выдан пользователю."""
+    await _write("""
+        UPDATE tracks SET last_access=?, hit_count=hit_count + 1 WHERE mp3_path=?
+    """, (now, mp3_path))
+
+async def register_file(mp3_path: str, size: int, now: float):
+    """Файл появился на диске (скачан) — запоминаем размер."""
+    await _write("""
+        UPDATE tracks SET size_bytes=?, last_access=? WHERE mp3_path=?
+    """, (size, now, mp3_path))
+
+async def cache_files() -> list[Dict]:
+    """Все mp3 из tracks (строка на трек — значит, и на файл)."""
+    rows = await _fetchall("""
+        SELECT mp3_path, size_bytes, last_access, hit_count, audio_file_id IS NOT NULL, created_at, youtube_id
+        FROM tracks
+        WHERE mp3_path IS NOT NULL AND mp3_path != ''
+    """)
+    return [
+        {"mp3_path": r[0], "size_bytes": r[1], "last_access": r[2],
+         "hit_count": r[3], "has_file_id": bool(r[4]), "created_at": r[5], "youtube_id": r[6]}
+        for r in rows
+    ]
+
+async def youtube_ids() -> set[str]:
+    return {r[0] for r in await _fetchall("SELECT youtube_id FROM tracks")}
+
+async def rename_file(old_path: str, new_path: str):
+    await _write("UPDATE tracks SET mp3_path=? WHERE mp3_path=?", (new_path, old_path))
+
+async def delete_file_rows(mp3_path: str):
+    """Удаляет трек без файла и без file_id (его ключи уходят каскадом)."""
+    await _write("DELETE FROM tracks WHERE mp3_path=?", (mp3_path,))
 
-def save_track_url(url: str, ahash: str, artist: str, title: str, mp3_path: str, youtube_id: str, source_url: str):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT OR REPLACE INTO tracks (url, source_url, audio_hash, artist, title, mp3_path, youtube_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (url, source_url, ahash, artist, title, mp3_path, youtube_id))
-    conn.commit()
-    conn.close()
 def normalize(s: str) -> str:
     """Удаляет диакритику и приводит строку к нижнему регистру."""
     return ''.join(
@@ -79,22 +534,46 @@ def normalize(s: str) -> str:
         if unicodedata.category(c) != 'Mn'
     )
 
-def get_by_title_or_artist(query: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+def tokens(s: str) -> list[str]:
+    return re.findall(r"\w+", normalize(s))
 
-    q = f"%{normalize(query)}%"
-    cur.execute("""
-        SELECT artist, title, mp3_path FROM tracks
-    """)
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-
-    # Фильтруем в Python (чтобы учесть нормализацию)
-    for r in rows:
-        t = normalize(r["title"])
-        a = normalize(r["artist"])
-        if q.strip('%') in t or q.strip('%') in a:
-            return r
-    return None
+def _fts_query(query: str, prefix: bool) -> str | None:
+    words = tokens(query)
+    if not words:
+        return None
+    # каждое слово в кавычках (без FTS-синтаксиса от пользователя), последнее — как префикс
+    terms = [f'"{w}"' for w in words]
+    if prefix:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+async def search_tracks(query: str, limit: int = 10, offset: int = 0, prefix: bool = True,
+                        with_file_id: bool = False) -> list[Dict]:
+    """
+    Поиск по кэшу треков через FTS5: все слова запроса должны встретиться
+    в названии или исполнителе. Результаты по релевантности (bm25, название весомее).
+    with_file_id — только треки, которые Telegram отдаст по file_id (inline-режим).
+    """
+    match = _fts_query(query, prefix)
+    if not match:
+        return []
+
+    rows = await _fetchall(f"""
+        SELECT {_TRACK}
+        FROM tracks_fts
+        JOIN tracks t ON t.id = tracks_fts.rowid
+        WHERE tracks_fts MATCH ? {"AND t.audio_file_id IS NOT NULL" if with_file_id else ""}
+        ORDER BY bm25(tracks_fts, 2.0, 1.0), t.audio_file_id IS NULL
+        LIMIT ? OFFSET ?
+    """, (match, limit, offset))
+    return [_track(r) for r in rows]
+
+async def popular_tracks(limit: int = 20, offset: int = 0) -> list[Dict]:
+    """Самые запрашиваемые треки с file_id."""
+    rows = await _fetchall(f"""
+        SELECT {_TRACK} FROM tracks t
+        WHERE t.audio_file_id IS NOT NULL
+        ORDER BY t.hit_count DESC
+        LIMIT ? OFFSET ?
+    """, (limit, offset))
+    return [_track(r) for r in rows]
@@ -0,0 +1,99 @@
+import re
+from pathlib import Path
+from telegram import Bot, Message
+from telegram.error import BadRequest
+from .config import cover_bytes, log
+from .cache import register, touch
+from .metrics import timed
+from .db import get_audio_file_id, save_audio_file_id, save_track
+from .youtube import download_mp3
+
+async def send_audio(message: Message, mp3_path: Path | str, title: str, performer: str) -> Message | None:
+    """
+    Отправляет трек пользователю.
+    Если Telegram уже видел этот mp3 — шлём по file_id (без повторной загрузки),
+    иначе загружаем файл с обложкой и запоминаем полученные file_id.
+    None — запись устарела: file_id отклонён, а файл уже выселен (трек нужно скачать заново).
+    """
+    key = str(mp3_path)
+
+    fid = await get_audio_file_id(key)
+    if fid:
+        try:
+            # обложка привязана к самому file_id, передавать thumbnail не нужно (и нельзя)
+            async with timed("tg_send_file_id"):
+                sent = await message.reply_audio(audio=fid, title=title, performer=performer)
+            await touch(key)
+            return sent
+        except BadRequest as e:
+            log.warning(f"[Delivery] ⚠ file_id отклонён Telegram ({e}) — загружаю заново: {key}")
+            await save_audio_file_id(key, None, None)
+
+    if not Path(key).exists():
+        log.warning(f"[Delivery] ⚠ Файла уже нет в кэше: {key}")
+        return None
+
+    async with timed("tg_upload"):
+        with open(key, "rb") as audio:
+            sent = await message.reply_audio(
+                audio=audio,
+                title=title,
+                performer=performer,
+                thumbnail=cover_bytes(),
+                filename=_filename(title),
+            )
+
+    await _remember_file_id(key, sent)
+    await touch(key)
+    return sent
+
+async def send_track(message: Message, track: dict, performer: str) -> Message | None:
+    """
+    send_audio для трека из базы: если запись устарела (file_id отклонён, файл выселен),
+    трек качается заново по youtube_id и отправляется уже файлом.
+    """
+    sent = await send_audio(message, track["mp3_path"], title=track["title"], performer=performer)
+    if sent is not None:
+        return sent
+
+    vid = track["youtube_id"]
+    mp3 = await download_mp3(vid, track["artist"], track["title"])
+    if not mp3:
+        await message.reply_text("⚠️ Трек пропал из кэша, а скачать его заново не удалось.")
+        return None
+    await save_track(vid, track["artist"], track["title"], str(mp3))
+    await register(mp3)
+    return await send_audio(message, mp3, title=track["title"], performer=performer)
+
+def _filename(title: str) -> str:
+    # на диске файл назван по youtube id — пользователю показываем название
+    return re.sub(r'[\\/*?:"<>|]', "_", title)[:120] + ".mp3"
+
+async def _remember_file_id(key: str, sent: Message) -> str | None:
+    if not sent.audio:
+        return None
+    thumb_fid = sent.audio.thumbnail.file_id if sent.audio.thumbnail else None
+    await save_audio_file_id(key, sent.audio.file_id, thumb_fid)
+    log.info(f"[Delivery] 💾 file_id сохранён для {Path(key).name}")
+    return sent.audio.file_id
+
+async def store_audio(bot: Bot, chat_id: int, mp3_path: Path | str, title: str, performer: str | None) -> str | None:
+    """
+    Загружает mp3 в служебный чат только ради file_id — чтобы трек можно было
+    отдать в inline-режиме, не дожидаясь, пока его кто-то запросит в личке.
+    """
+    key = str(mp3_path)
+    if fid := await get_audio_file_id(key):
+        return fid
+    async with timed("tg_upload"):
+        with open(key, "rb") as audio:
+            sent = await bot.send_audio(
+                chat_id,
+                audio=audio,
+                title=title,
+                performer=performer,
+                thumbnail=cover_bytes(),
+                filename=_filename(title),
+                disable_notification=True,
+            )
+    return await _remember_file_id(key, sent)
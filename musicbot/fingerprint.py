@@ -0,0 +1,312 @@
+"""
+Локальные аудио-отпечатки (спектральные пики + хэши пар пиков).
+
+Устойчивы к сдвигу по времени, смене битрейта и перекодированию,
+поэтому одна и та же песня из разных видео находится без запроса в AUDD.
+
+Офлайн-проверка на файлах из cache/mp3:
+    python -m musicbot.fingerprint index
+    python -m musicbot.fingerprint bench
+"""
+import asyncio
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from .config import FFMPEG, FP_DB_PATH, FP_MIN_MATCHES, FP_MIN_CONFIDENCE, MP3_DIR, log
+
+SAMPLE_RATE = 11025
+N_FFT = 1024
+HOP = 256                 # ~23 мс на кадр
+PEAK_TIME = 10            # окрестность пика: ±кадров
+PEAK_FREQ = 10            # и ±частотных бинов
+PEAK_DB = 10.0            # пик должен быть громче медианы спектра на столько дБ
+FAN_OUT = 5               # сколько соседних пиков берём в пару к каждому якорю
+MAX_DT = 63               # максимальное расстояние в паре (кадров)
+OFFSET_BIN = 2            # допуск выравнивания по времени (кадров)
+_SQL_CHUNK = 900
+
+@dataclass
+class Match:
+    track_id: str          # youtube_id трека
+    offset: float          # где в треке начинается фрагмент, сек
+    matches: int           # число хэшей, совпавших с одним выравниванием
+    confidence: float      # matches / число хэшей запроса
+
+# === PCM ===
+def _pcm_cmd(path: Path, start: float | None, duration: float | None) -> list[str]:
+    cmd = [FFMPEG, "-hide_banner", "-loglevel", "error"]
+    if start:
+        cmd += ["-ss", str(start)]
+    cmd += ["-i", str(path)]
+    if duration:
+        cmd += ["-t", str(duration)]
+    return cmd + ["-vn", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"]
+
+def _to_float(raw: bytes) -> np.ndarray:
+    return np.frombuffer(raw, dtype=np.int16).astype(np.float32) / 32768.0
+
+def decode_pcm(path: Path, start: float | None = None, duration: float | None = None) -> np.ndarray:
+    """Моно PCM 11025 Гц (float32) через ffmpeg."""
+    proc = subprocess.run(_pcm_cmd(path, start, duration), capture_output=True)
+    return _to_float(proc.stdout)
+
+# === Отпечаток ===
+def _spectrogram(pcm: np.ndarray) -> np.ndarray:
+    frames = sliding_window_view(pcm, N_FFT)[::HOP] * np.hanning(N_FFT).astype(np.float32)
+    mag = np.abs(np.fft.rfft(frames, axis=1))
+    return 20 * np.log10(mag + 1e-6)
+
+def _max_filter(spec: np.ndarray) -> np.ndarray:
+    # прямоугольный максимум-фильтр раскладывается на два одномерных
+    padded = np.pad(spec, ((0, 0), (PEAK_FREQ, PEAK_FREQ)), constant_values=-np.inf)
+    out = sliding_window_view(padded, 2 * PEAK_FREQ + 1, axis=1).max(axis=-1)
+    padded = np.pad(out, ((PEAK_TIME, PEAK_TIME), (0, 0)), constant_values=-np.inf)
+    return sliding_window_view(padded, 2 * PEAK_TIME + 1, axis=0).max(axis=-1)
+
+def _peaks(spec: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Локальные максимумы спектрограммы (кадр, бин), отсортированные по времени."""
+    threshold = np.median(spec) + PEAK_DB
+    t, f = np.nonzero((spec == _max_filter(spec)) & (spec > threshold))
+    order = np.lexsort((f, t))
+    return t[order], f[order]
+
+def fingerprint(pcm: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Возвращает (hashes, offsets): хэш пары пиков (f1, f2, dt) и кадр якоря.
+    Пустые массивы — если звука слишком мало.
+    """
+    if len(pcm) < N_FFT * 4:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+
+    t, f = _peaks(_spectrogram(pcm))
+    hashes, offsets = [], []
+    for k in range(1, FAN_OUT + 1):
+        t1, f1, t2, f2 = t[:-k], f[:-k], t[k:], f[k:]
+        dt = t2 - t1
+        ok = (dt > 0) & (dt <= MAX_DT)
+        hashes.append((f1[ok].astype(np.int64) << 20) | (f2[ok].astype(np.int64) << 10) | dt[ok])
+        offsets.append(t1[ok].astype(np.int64))
+    return np.concatenate(hashes), np.concatenate(offsets)
+
+# === Индекс (hash → track_id, offset) рядом с cache.db ===
+# Поиск идёт из потоков asyncio.to_thread: у каждого потока одно своё
+# соединение (sqlite3 не делит соединение между потоками), схема создаётся один раз.
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def _init_schema(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            hash INTEGER NOT NULL,
+            track_id TEXT NOT NULL,
+            offset INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fp_hash ON fingerprints(hash)")
+    # удаление трека из индекса (переиндексация, выселение из кэша)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fp_track ON fingerprints(track_id)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fp_tracks (
+            track_id TEXT PRIMARY KEY,
+            hashes INTEGER,
+            indexed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        return conn
+
+    conn = sqlite3.connect(FP_DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    with _schema_lock:
+        if not _schema_ready:
+            _init_schema(conn)
+            _schema_ready = True
+    _local.conn = conn
+    return conn
+
+def is_indexed(track_id: str) -> bool:
+    row = _connect().execute("SELECT 1 FROM fp_tracks WHERE track_id=?", (track_id,)).fetchone()
+    return row is not None
+
+def index_file(track_id: str, path: Path) -> int:
+    """Добавляет трек в индекс (переиндексирует, если уже был). Возвращает число хэшей."""
+    hashes, offsets = fingerprint(decode_pcm(path))
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM fingerprints WHERE track_id=?", (track_id,))
+        conn.executemany(
+            "INSERT INTO fingerprints (hash, track_id, offset) VALUES (?, ?, ?)",
+            ((int(h), track_id, int(o)) for h, o in zip(hashes, offsets)),
+        )
+        conn.execute("INSERT OR REPLACE INTO fp_tracks (track_id, hashes) VALUES (?, ?)", (track_id, len(hashes)))
+    return len(hashes)
+
+def forget(track_ids: Iterable[str]) -> int:
+    """Убирает треки из индекса. Возвращает, сколько треков удалено."""
+    conn = _connect()
+    removed = 0
+    with conn:
+        for track_id in track_ids:
+            conn.execute("DELETE FROM fingerprints WHERE track_id=?", (track_id,))
+            removed += conn.execute("DELETE FROM fp_tracks WHERE track_id=?", (track_id,)).rowcount
+    return removed
+
+def indexed_before(age: float) -> set[str]:
+    """Треки, проиндексированные больше age секунд назад."""
+    rows = _connect().execute(
+        "SELECT track_id FROM fp_tracks WHERE indexed_at < datetime('now', ?)", (f"-{int(age)} seconds",),
+    )
+    return {r[0] for r in rows}
+
+def lookup_pcm(pcm: np.ndarray) -> Match | None:
+    """Лучшее совпадение с учётом выравнивания по времени или None."""
+    hashes, offsets = fingerprint(pcm)
+    if not len(hashes):
+        return None
+
+    query_offsets: dict[int, list[int]] = {}
+    for h, o in zip(hashes.tolist(), offsets.tolist()):
+        query_offsets.setdefault(h, []).append(o)
+
+    keys = list(query_offsets)
+    votes: dict[tuple[str, int], int] = {}
+    conn = _connect()
+    for i in range(0, len(keys), _SQL_CHUNK):
+        chunk = keys[i:i + _SQL_CHUNK]
+        rows = conn.execute(
+            f"SELECT hash, track_id, offset FROM fingerprints WHERE hash IN ({','.join('?' * len(chunk))})",
+            chunk,
+        )
+        for h, track_id, db_offset in rows:
+            for q in query_offsets[h]:
+                key = (track_id, (db_offset - q) // OFFSET_BIN)
+                votes[key] = votes.get(key, 0) + 1
+
+    if not votes:
+        return None
+    (track_id, delta), best = max(votes.items(), key=lambda kv: kv[1])
+    return Match(
+        track_id=track_id,
+        offset=max(delta * OFFSET_BIN, 0) * HOP / SAMPLE_RATE,
+        matches=best,
+        confidence=best / len(hashes),
+    )
+
+def is_confident(match: Match | None) -> bool:
+    return bool(match) and match.matches >= FP_MIN_MATCHES and match.confidence >= FP_MIN_CONFIDENCE
+
+# === Асинхронный API для пайплайна ===
+async def lookup_audio(pcm: np.ndarray) -> Match | None:
+    """Ищет уже декодированный звук в локальном индексе; возвращает только уверенные совпадения."""
+    try:
+        match = await asyncio.to_thread(lookup_pcm, pcm)
+    except Exception as e:
+        log.error(f"[FP] ❌ Ошибка поиска отпечатка: {e}")
+        return None
+
+    if match:
+        log.info(f"[FP] 🔎 {match.track_id}: {match.matches} совпадений, conf={match.confidence:.3f}")
+    return match if is_confident(match) else None
+
+async def index_track(track_id: str, path: Path):
+    """Индексирует скачанный трек в фоне; ошибки только логируются."""
+    try:
+        if await asyncio.to_thread(is_indexed, track_id):
+            return
+        n = await asyncio.to_thread(index_file, track_id, path)
+        log.info(f"[FP] 🧬 Проиндексирован {track_id}: {n} хэшей")
+    except Exception as e:
+        log.error(f"[FP] ❌ Ошибка индексации {track_id}: {e}")
+
+async def forget_tracks(track_ids: Iterable[str]):
+    """Треки ушли из кэша — их отпечатки больше не нужны."""
+    track_ids = list(track_ids)
+    if not track_ids:
+        return
+    try:
+        n = await asyncio.to_thread(forget, track_ids)
+        log.info(f"[FP] 🧹 Удалено из индекса: {n}")
+    except Exception as e:
+        log.error(f"[FP] ❌ Ошибка удаления из индекса: {e}")
+
+# === Офлайн: индексация и бенчмарк по cache/mp3 ===
+_ID_RE = re.compile(r"\[([\w-]{11})\]")
+
+def _cached_mp3s() -> Iterable[tuple[str, Path]]:
+    for path in sorted(MP3_DIR.glob("*.mp3")):
+        if m := _ID_RE.search(path.name):
+            yield m.group(1), path
+
+def _reencoded_pcm(path: Path, start: float, duration: float, bitrate: str) -> np.ndarray:
+    """Фрагмент, прогнанный через mp3 с другим битрейтом, — как будто из другого видео."""
+    enc = subprocess.run(
+        [FFMPEG, "-hide_banner", "-loglevel", "error", "-ss", str(start), "-i", str(path),
+         "-t", str(duration), "-ac", "2", "-ar", "44100", "-b:a", bitrate, "-f", "mp3", "-"],
+        capture_output=True,
+    ).stdout
+    dec = subprocess.run(
+        [FFMPEG, "-hide_banner", "-loglevel", "error", "-i", "-",
+         "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"],
+        input=enc, capture_output=True,
+    ).stdout
+    return _to_float(dec)
+
+def _cmd_index():
+    for track_id, path in _cached_mp3s():
+        started = time.perf_counter()
+        n = index_file(track_id, path)
+        print(f"{track_id}  {n:6d} хэшей  {time.perf_counter() - started:.2f} сек  {path.name}")
+
+def _cmd_bench():
+    tracks = list(_cached_mp3s())
+    for track_id, path in tracks:
+        if not is_indexed(track_id):
+            index_file(track_id, path)
+
+    total = hits = 0
+    lookup_times = []
+    for track_id, path in tracks:
+        for start in (3, 17, 41):
+            for bitrate in ("64k", "128k"):
+                pcm = _reencoded_pcm(path, start, 10, bitrate)
+                if len(pcm) < SAMPLE_RATE:
+                    continue
+                started = time.perf_counter()
+                match = lookup_pcm(pcm)
+                lookup_times.append(time.perf_counter() - started)
+                ok = is_confident(match) and match.track_id == track_id
+                total += 1
+                hits += ok
+                found = f"{match.track_id} @{match.offset:.1f}s m={match.matches} conf={match.confidence:.3f}" if match else "—"
+                print(f"{'✅' if ok else '❌'} {track_id} start={start}s {bitrate}: {found}")
+
+    noise = np.random.default_rng(0).normal(0, 0.1, SAMPLE_RATE * 10).astype(np.float32)
+    false_positive = is_confident(lookup_pcm(noise))
+
+    if lookup_times:
+        times = np.array(lookup_times) * 1000
+        print(f"\nТочность: {hits}/{total}  lookup p50={np.percentile(times, 50):.1f} мс  p95={np.percentile(times, 95):.1f} мс")
+    print(f"Ложное срабатывание на шуме: {'да ❌' if false_positive else 'нет ✅'}")
+
+if __name__ == "__main__":
+    commands = {"index": _cmd_index, "bench": _cmd_bench}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print("usage: python -m musicbot.fingerprint index|bench")
+        sys.exit(1)
+    commands[sys.argv[1]]()
@@ -1,218 +1,121 @@
 from telegram import Update
-from telegram.ext import ContextTypes
-from .db import get_by_file_id, get_by_audio_hash, save_track
-from .audio import tg_download_video, extract_audio_snip, audio_hash
-from .audd import audd_recognize
-from .youtube import search_youtube_music, download_mp3, search_youtube_list
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes, InlineQueryHandler, MessageHandler, filters
+from .youtube import download_mp3, search_youtube_list_async
+from .delivery import send_audio, send_track
+from .pipeline import PipelineError, ingest_video, ingest_link, run_background
+from .fingerprint import index_track
+from .scheduler import QueueFull, job
+from .metrics import request_timer, summary
+from .prefetch import prefetch, release
+from .batch import find_urls, is_batch, run_batch
+from . import inline
+from . import choices
 import re
-from pathlib import Path
-from yt_dlp import YoutubeDL
-from .config import MP3_DIR
-from .db import get_by_url, save_track_url
-from .db import get_by_title_or_artist, get_by_url, save_track_url
+from .config import ADMIN_IDS, INLINE_CACHE_TIME, log
+from .cache import record_lookup, register, is_deliverable
+from .db import get_by_url, get_by_video, get_by_query, get_by_youtube_id, save_track, search_tracks, tokens
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-import time
-EXPIRE_TIME = 60
+BUSY_TEXT = "🚦 Сейчас слишком много запросов. Попробуй через минуту."
 
 
-import asyncio
+def _queued_reply(message):
+    async def reply(position: int):
+        await message.reply_text(f"⏳ Много запросов — ты в очереди: {position}")
+    return reply
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🎵 Отправь видео с музыкой — я распознаю и скачаю MP3!")
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сводка метрик — только для ADMIN_IDS, остальным бот молчит."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text("📊 " + summary()[:4000])
+
+@request_timer("video")
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     m = update.message
-    video = None
-    snip = None
-    mp3 = None
     user = m.from_user
     username = user.username or user.first_name or "Unknown"
 
     try:
         await m.reply_chat_action("typing")
 
-        # 1️⃣ Скачиваем и извлекаем звук
-        video = await tg_download_video(update, context)
-        snip = await extract_audio_snip(video)
-        if not snip:
-            await m.reply_text("⚠️ Не удалось извлечь звук из видео.")
+        # 🧠 Это видео уже присылали (пересылка) — звук не качаем
+        cached = await get_by_video(m.video.file_unique_id)
+        record_lookup("video", bool(cached and is_deliverable(cached)))
+        if cached and is_deliverable(cached):
+            await m.reply_text(f"⚡ Из кэша: {cached['artist']} — {cached['title']}")
+            await send_track(m, cached, performer=username)
             return
 
-        # 2️⃣ Проверяем кэш по аудио-хэшу
-        ahash = audio_hash(snip)
-        if cached := get_by_audio_hash(ahash):
-            await m.reply_text(f"⚡ Найдено по звуку: {cached['artist']} — {cached['title']}")
-            youtube_url = (
-                f"https://www.youtube.com/watch?v={cached.get('youtube_id', '')}"
-                if cached.get("youtube_id")
-                else ""
-            )
-            save_track_url(
-                url="",
-                ahash=ahash,
-                artist=cached["artist"],
-                title=cached["title"],
-                mp3_path=cached["mp3_path"],
-                youtube_id=cached.get("youtube_id", ""),
-                source_url=youtube_url,
-            )
-            await m.reply_audio(
-                audio=open(cached["mp3_path"], "rb"),
-                title=cached["title"],  # ← красивое название без [ID]
-                performer=username,
-                thumbnail=open("assets/logo1.jpg", "rb")
-            )
-            return
-
-        # 3️⃣ Распознаём через AUDD
         await m.reply_text("🎧 Распознаю трек через AUDD...")
-        audd = await audd_recognize(snip)
-        if not audd:
-            await m.reply_text("❌ Не удалось распознать трек.")
-            return
 
-        artist = audd.get("artist", "Unknown")
-        title = audd.get("title", "Unknown")
-        duration = audd.get("timecode", 0) or audd.get("length", 0)
+        # 1️⃣ Скачиваем, извлекаем звук, распознаём (одинаковые видео — одна задача)
+        async with job(user.id, on_queued=_queued_reply(m)):
+            track = await ingest_video(context.bot, m.video.file_id, m.video.file_unique_id)
 
-        # 4️⃣ Поиск на YouTube
-        vid = search_youtube_music(title, artist, duration)
-        if not vid:
-            await m.reply_text("⚠️ Не удалось найти трек на YouTube.")
-            return
-
-        # 5️⃣ Скачиваем MP3
-        mp3 = await download_mp3(vid, artist, title)
-        if not mp3:
-            await m.reply_text("⚠️ Ошибка при скачивании MP3.")
-            return
+        if track["cached"]:
+            await m.reply_text(f"⚡ Найдено по звуку: {track['artist']} — {track['title']}")
 
-        youtube_url = f"https://www.youtube.com/watch?v={vid}"
+        # 2️⃣ Отправляем пользователю
+        await send_track(m, track, performer=username)
 
-        # 6️⃣ Сохраняем результат
-        save_track_url(
-            url="",
-            ahash=ahash,
-            artist=artist,
-            title=title,
-            mp3_path=str(mp3),
-            youtube_id=vid,
-            source_url=youtube_url,
-        )
+    except PipelineError as e:
+        await m.reply_text(str(e))
 
-        # 7️⃣ Отправляем пользователю
-
-        await m.reply_audio(
-            audio=open(mp3, "rb"),
-            title=title,
-            performer=username,
-            thumbnail=open("assets/logo1.jpg", "rb"),
-        )
+    except QueueFull:
+        await m.reply_text(BUSY_TEXT)
 
     except Exception as e:
         # централизованная обработка всех неожиданных ошибок
-        from .config import log
         log.error(f"[handle_video] ❌ Ошибка: {e}", exc_info=True)
         await m.reply_text("⚠️ Произошла непредвиденная ошибка. Попробуй позже.")
 
-    finally:
-        # 8️⃣ Очистка всех временных файлов
-        cleanup_files(video, snip, mp3)
-
+@request_timer("link")
 async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     m = update.message
-    url = m.text.strip()
     user = m.from_user
     username = user.username or user.first_name or "Unknown"
 
-    if not re.match(r'https?://', url):
+    urls = find_urls(m.text)
+    if not urls:
         return
+    # несколько ссылок или плейлист — пакетом, треки приходят по мере готовности
+    if is_batch(urls):
+        await run_batch(m, urls, username)
+        return
+    url = urls[0]
 
     await m.reply_chat_action("typing")
 
     # 🧠 1️⃣ Проверяем кэш по ссылке
-    if cached := get_by_url(url):
+    cached = await get_by_url(url)
+    record_lookup("url", bool(cached and is_deliverable(cached)))
+    if cached and is_deliverable(cached):
         await m.reply_text(f"⚡ Из кэша (по ссылке): {cached['artist']} — {cached['title']}")
-        await m.reply_audio(
-            audio=open(cached["mp3_path"], "rb"),
-            title=cached["title"],  # ← красивое название без [ID]
-            performer=username,
-            thumbnail=open("assets/logo1.jpg", "rb")
-        )
-        return
+        await send_track(m, cached, performer=username)
         return
 
-    tmp_video = Path("temp_video.mp4")
-    snip = None
-
+    # 2️⃣ Скачиваем, извлекаем звук, распознаём (одинаковые ссылки — одна задача)
+    await m.reply_text("🎧 Распознаю трек через AUDD...")
     try:
-        # 2️⃣ Скачиваем видео
-        ydl_opts = {
-            "format": "mp4",
-            "quiet": True,
-            "outtmpl": str(tmp_video),
-        }
-
-        await asyncio.to_thread(lambda: YoutubeDL(ydl_opts).download([url]))
-
-        # 3️⃣ Извлекаем звук
-        snip = await extract_audio_snip(tmp_video)
-        if not snip:
-            await m.reply_text("⚠️ Не удалось извлечь звук из видео.")
-            return
-
-        # 4️⃣ Проверяем кэш по звуку
-        ahash = audio_hash(snip)
-        if cached := get_by_audio_hash(ahash):
-            await m.reply_text(f"⚡ Найдено по звуку: {cached['artist']} — {cached['title']}")
-            save_track_url(url, ahash, cached["artist"], cached["title"], cached["mp3_path"], "", "")
-            await m.reply_audio(
-                audio=open(cached["mp3_path"], "rb"),
-                title=cached["title"],  # ← красивое название без [ID]
-                performer=username,
-                thumbnail=open("assets/logo1.jpg", "rb")
-            )
-            return
-
-        # 5️⃣ Распознаём через AUDD
-        await m.reply_text("🎧 Распознаю трек через AUDD...")
-        audd = await audd_recognize(snip)
-        if not audd:
-            await m.reply_text("❌ Не удалось распознать трек.")
-            return
-
-        artist = audd.get("artist", "Unknown")
-        title  = audd.get("title", "Unknown")
-        query  = f"{artist} {title} official audio"
-
-        # 6️⃣ Ищем и скачиваем MP3
-        duration = audd.get("timecode", 0) or audd.get("length", 0)
-        vid = search_youtube_music(title, artist, duration)
-        if not vid:
-            await m.reply_text("⚠️ Не удалось найти трек на YouTube.")
-            return
+        async with job(user.id, on_queued=_queued_reply(m)):
+            track = await ingest_link(url)
+    except PipelineError as e:
+        await m.reply_text(str(e))
+        return
+    except QueueFull:
+        await m.reply_text(BUSY_TEXT)
+        return
 
-        mp3 = await download_mp3(vid, artist, title)
-        if not mp3:
-            await m.reply_text("⚠️ Ошибка при скачивании MP3.")
-            return
-        print(vid)
-        youtube_url = f"https://www.youtube.com/watch?v={vid}"
-
-        # 7️⃣ Сохраняем результат и кэшируем ссылку
-        save_track_url(url, ahash, artist, title, str(mp3), vid, youtube_url)
-        await m.reply_text(f"🎶 {artist} — {title}")
-        await m.reply_audio(
-            audio=open(mp3, "rb"),
-            title=title,
-            performer=username,
-            thumbnail=open("assets/logo1.jpg", "rb"),
-        )
-
-    finally:
-        cleanup_files(tmp_video, snip)
-# временное хранилище выбора (user_id -> список треков)
-user_choices = {}
+    if track["cached"]:
+        await m.reply_text(f"⚡ Найдено по звуку: {track['artist']} — {track['title']}")
+    else:
+        await m.reply_text(f"🎶 {track['artist']} — {track['title']}")
 
+    await send_track(m, track, performer=username)
+@request_timer("text")
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     m = update.message
     query = m.text.strip()
@@ -221,49 +124,73 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     await m.reply_chat_action("typing")
+    user = m.from_user
+    username = user.username or user.first_name or "Unknown"
+
+    # 0️⃣ Полное название есть в кэше — отвечаем без YouTube
+    for cached in await search_tracks(query, limit=3, prefix=False):
+        if not _covers_title(query, cached) or not is_deliverable(cached):
+            continue
+        record_lookup("title", True)
+        await m.reply_text(f"⚡ Из кэша: {cached['artist']} — {cached['title']}")
+        await send_track(m, cached, performer=username)
+        return
+
+    record_lookup("title", False)
 
     # 1️⃣ Ищем треки
-    tracks = search_youtube_list(query, limit=10)
+    tracks = await search_youtube_list_async(query, limit=10)
     if not tracks:
         await m.reply_text("⚠️ Не удалось найти треки.")
         return
+    tracks = await _rank_remembered(query, tracks)
 
-    # 2️⃣ Сохраняем выбор
-    user_choices[m.from_user.id] = {
-        "tracks": tracks,
-        "timestamp": time.time(),
-        "message_id": None,
-    }
+    # 2️⃣ Открываем сессию выбора; прошлая клавиатура пользователя закрывается
+    session, previous = await choices.open_session(user.id, m.chat_id, tracks, query)
+    if previous and previous.message_id:
+        try:
+            await context.bot.delete_message(chat_id=previous.chat_id, message_id=previous.message_id)
+        except Exception:
+            pass
 
     # 3️⃣ Формируем текст и кнопки
     text_lines = []
     buttons = []
-    for i, t in enumerate(tracks, start=1):
-        title = t.get("title", "Без названия")
-        duration = int(float(t.get("duration", 0) or 0))
-        mins, secs = divmod(duration, 60)
-        text_lines.append(f"{i}. {title} ({mins}:{secs:02d})")
-        buttons.append([InlineKeyboardButton(str(i), callback_data=f"choose_{i}")])
+    for i, c in enumerate(session.candidates, start=1):
+        mins, secs = divmod(c.duration, 60)
+        text_lines.append(f"{i}. {c.title} ({mins}:{secs:02d})")
+        buttons.append([InlineKeyboardButton(str(i), callback_data=choices.callback_data(session.sid, i))])
 
     text = "🎶 Найдено несколько треков:\n\n" + "\n".join(text_lines)
     markup = InlineKeyboardMarkup(buttons)
 
     msg = await m.reply_text(text, reply_markup=markup)
-    user_choices[m.from_user.id]["message_id"] = msg.message_id
-
-    # 4️⃣ Запускаем таймер удаления в фоне
-    asyncio.create_task(delete_message_later(context, m.chat_id, msg.message_id, m.from_user.id))
-
-
-async def delete_message_later(context, chat_id, message_id, user_id):
-    """Удаляет сообщение через EXPIRE_TIME секунд"""
-    await asyncio.sleep(EXPIRE_TIME)
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        user_choices.pop(user_id, None)
-    except Exception:
-        pass
-
+    await choices.attach_message(session, msg.message_id)
+
+    # 4️⃣ Пока пользователь выбирает — качаем самый вероятный вариант
+    # (клавиатуру по истечении CHOICE_TTL удалит choices.sweeper)
+    session.prefetch = prefetch(session.candidates)
+
+
+async def _rank_remembered(query: str, entries: list[dict]) -> list[dict]:
+    """
+    Трек, который по такому запросу уже выбирали, — первой кнопкой (его и предзагрузим).
+    Память запросов общая для всех, поэтому это только подсказка: выбирает пользователь.
+    """
+    remembered = await get_by_query(query)
+    if not remembered:
+        return entries
+    first = next((e for e in entries if e.get("id") == remembered["youtube_id"]), None)
+    if first is None:
+        return entries
+    return [first] + [e for e in entries if e is not first]
+
+def _covers_title(query: str, track: dict) -> bool:
+    """Пользователь ввёл название целиком (а не одно общее слово вроде «love»)."""
+    title_words = set(tokens(track["title"] or ""))
+    return bool(title_words) and title_words <= set(tokens(query))
+
+@request_timer("choice")
 async def handle_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     query = update.callback_query
@@ -274,61 +201,86 @@ async def handle_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = user.username or user.first_name or "Unknown"
 
 
-    if not data.startswith("choose_"):
-        return
-
-    user_data = user_choices.get(user_id)
-    if not user_data:
+    parsed = choices.parse_callback(data)
+    if not parsed:
+        # кнопки старого формата (до рестарта) или чужие callback_data
         await query.edit_message_text("⚠️ Выбор устарел.")
         return
 
-    # проверяем время жизни
-    if time.time() - user_data["timestamp"] > EXPIRE_TIME:
+    sid, number = parsed
+    session = await choices.get(sid)
+    if not session or session.user_id != user_id:
         await query.edit_message_text("⚠️ Время выбора истекло.")
-        user_choices.pop(user_id, None)
         return
 
-    tracks = user_data["tracks"]
-    idx = int(data.split("_")[1]) - 1
-    if idx < 0 or idx >= len(tracks):
+    idx = number - 1
+    if idx < 0 or idx >= len(session.candidates):
         await query.edit_message_text("⚠️ Неверный выбор.")
         return
 
-    chosen = tracks[idx]
-    vid = chosen.get("id")
-    title = chosen.get("title", "Unknown")
+    chosen = session.candidates[idx]
+    vid = chosen.id
+    title = chosen.title
     artist = "Unknown"
-    youtube_url = f"https://www.youtube.com/watch?v={vid}"
+
+    # выбранный вариант мог уже скачаться заранее — остальные не нужны
+    release(session.prefetch, keep=vid)
+
+    # этот youtube_id уже в кэше (распознан по видео или выбран раньше) — не качаем
+    cached = await get_by_youtube_id(vid)
+    record_lookup("youtube_id", bool(cached and is_deliverable(cached)))
+    if cached and is_deliverable(cached):
+        await save_track(vid, cached["artist"], cached["title"], cached["mp3_path"], query=session.query)
+        await query.message.reply_text(f"⚡ Из кэша: {cached['artist']} — {cached['title']}")
+        await send_track(query.message, cached, performer=username)
+        return
 
     await query.message.reply_text(f"🎧 Скачиваю: {title}...")
 
-    mp3 = await download_mp3(vid, artist, title)
+    try:
+        async with job(user_id, on_queued=_queued_reply(query.message)):
+            mp3 = await download_mp3(vid, artist, title)
+    except QueueFull:
+        await query.message.reply_text(BUSY_TEXT)
+        return
     if not mp3:
         await query.message.reply_text("⚠️ Ошибка при скачивании.")
         return
 
-    # 🔥 Сохраняем в базу
-    from .audio import audio_hash
-    ahash = audio_hash(mp3)
-    save_track_url(
-        url=None,  # пользовательского URL нет
-        ahash=ahash,
-        artist=artist,
-        title=title,
-        mp3_path=str(mp3),
-        youtube_id=vid,
-        source_url=youtube_url  # сохраняем только источник
-    )
+    # 🔥 Сохраняем в базу (хэш фрагмента здесь не нужен: трек найдётся по отпечатку),
+    # запрос пользователя — ключ: следующий такой же получит трек без клавиатуры
+    await save_track(vid, artist, title, str(mp3), query=session.query)
+    await register(mp3)
+    run_background(index_track(vid, mp3))
 
-    await query.message.reply_audio(
-        audio=open(mp3, "rb"),
+    await send_audio(
+        query.message,
+        mp3,
         title=title,  # 🎵 Название трека (в плеере)
         performer=username,  # 👤 Имя пользователя как “исполнитель”
-        thumbnail=open("assets/logo1.jpg", "rb")
     )
 
 
-def cleanup_files(*paths: Path):
-    for p in paths:
-        if p and p.exists():
-            p.unlink(missing_ok=True)
\ No newline at end of file
+@request_timer("inline")
+async def handle_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """@bot название — только из локального кэша, без загрузок в процессе ответа."""
+    q = update.inline_query
+    results, next_offset = await inline.lookup(q.query, q.offset)
+    await q.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+    if not results and not q.offset:
+        # в следующий раз трек найдётся сразу
+        inline.schedule_fetch(context.bot, q.from_user.id, q.query)
+
+def register_handlers(app: Application):
+    """Подключает обработчики к приложению (бот и бенчмарк используют один набор)."""
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(MessageHandler(filters.VIDEO & ~filters.COMMAND, handle_video))
+
+    # ссылки
+    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'https?://'), handle_link))
+
+    # обычный текст (название трека)
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(r'https?://'), handle_text))
+    app.add_handler(CallbackQueryHandler(handle_choice))
+    app.add_handler(InlineQueryHandler(handle_inline))
@@ -0,0 +1,138 @@
+"""
+Inline-режим (@bot название): ответ только из локального кэша — FTS-поиск
+по названию/исполнителю среди треков, у которых уже есть Telegram file_id,
+поэтому ответ укладывается в срок inline-запроса без YouTube и загрузок.
+Режим нужно включить у @BotFather (/setinline).
+
+Telegram шлёт запрос на каждое нажатие клавиши, поэтому:
+    - одинаковые страницы за INLINE_RESULT_TTL отдаются из памяти;
+    - ненайденное качается в фоне только после паузы в наборе (INLINE_FETCH_DELAY),
+      только при заданном INLINE_STORAGE_CHAT_ID (иначе у трека не будет file_id)
+      и только если загрузкам не мешает очередь настоящих запросов.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict
+from telegram import Bot, InlineQueryResultCachedAudio
+from .cache import is_deliverable, register
+from .choices import candidate
+from .config import (
+    INLINE_PAGE_SIZE, INLINE_RESULT_TTL, INLINE_RESULT_CACHE_SIZE, INLINE_FETCH_DELAY,
+    INLINE_FETCH_MIN_CHARS, INLINE_STORAGE_CHAT_ID, log,
+)
+from .db import get_by_query, get_by_youtube_id, popular_tracks, query_key, save_track, search_tracks
+from .delivery import store_audio
+from .fingerprint import index_track
+from .metrics import inc
+from .pipeline import run_background
+from .scheduler import QueueFull, has_capacity, job
+from .singleflight import single_flight
+from .youtube import download_mp3, search_youtube_list_async
+
+# (нормализованный запрос, offset) -> (результаты, next_offset, время)
+_pages: OrderedDict[tuple[str, int], tuple[list, str, float]] = OrderedDict()
+# user_id -> отложенная загрузка (новый запрос того же пользователя её отменяет)
+_pending: Dict[int, asyncio.Task] = {}
+
+def _result(track: Dict) -> InlineQueryResultCachedAudio:
+    return InlineQueryResultCachedAudio(id=track["youtube_id"], audio_file_id=track["audio_file_id"])
+
+async def lookup(query: str, offset: str = "") -> tuple[list, str]:
+    """Страница результатов и next_offset ("" — страниц больше нет)."""
+    inc("inline_events", event="query")
+    key = (query_key(query), int(offset) if offset.isdigit() else 0)
+
+    if page := _pages.get(key):
+        results, next_offset, created = page
+        if time.monotonic() - created < INLINE_RESULT_TTL:
+            _pages.move_to_end(key)
+            inc("inline_events", event="page_hit")
+            return results, next_offset
+
+    text, start = key
+    if text:
+        tracks = await search_tracks(text, limit=INLINE_PAGE_SIZE, offset=start, with_file_id=True)
+        more = len(tracks) == INLINE_PAGE_SIZE
+        # трек, скачанный по такому же запросу, мог не совпасть по словам названия
+        if not start and (exact := await get_by_query(text)) and exact["audio_file_id"]:
+            tracks = [exact] + [t for t in tracks if t["youtube_id"] != exact["youtube_id"]]
+    else:
+        # пустой запрос — самые популярные
+        tracks = await popular_tracks(limit=INLINE_PAGE_SIZE, offset=start)
+        more = len(tracks) == INLINE_PAGE_SIZE
+    results = [_result(t) for t in tracks]
+    next_offset = str(start + INLINE_PAGE_SIZE) if more else ""
+    if not results and not start:
+        inc("inline_events", event="empty")
+
+    _pages[key] = (results, next_offset, time.monotonic())
+    _pages.move_to_end(key)
+    while len(_pages) > INLINE_RESULT_CACHE_SIZE:
+        _pages.popitem(last=False)
+    return results, next_offset
+
+# === Фоновая загрузка ненайденного ===
+def schedule_fetch(bot: Bot, user_id: int, query: str):
+    """Запоминает промах; качаем, если пользователь перестал печатать."""
+    text = query_key(query)
+    # без служебного чата file_id не получить — скачанное в inline так и не появится
+    if not INLINE_STORAGE_CHAT_ID or len(text) < INLINE_FETCH_MIN_CHARS:
+        return
+    if previous := _pending.pop(user_id, None):
+        previous.cancel()
+    _pending[user_id] = asyncio.ensure_future(_fetch_later(bot, user_id, text))
+
+async def _fetch_later(bot: Bot, user_id: int, text: str):
+    await asyncio.sleep(INLINE_FETCH_DELAY)
+    # дальше не отменяем: следующий запрос пользователя — уже другая загрузка
+    if _pending.get(user_id) is asyncio.current_task():
+        del _pending[user_id]
+    run_background(single_flight(f"inline:{text}", lambda: _fetch(bot, user_id, text)))
+
+async def _fetch(bot: Bot, user_id: int, text: str):
+    # спекулятивная работа, как prefetch: не отнимаем загрузки у настоящих запросов
+    if not has_capacity("download"):
+        inc("inline_events", event="skipped")
+        return
+
+    # поиск и загрузка — задача пользователя в планировщике, как запрос из чата
+    try:
+        async with job(user_id):
+            mp3, title = await _fetch_track(text) or (None, None)
+    except QueueFull:
+        inc("inline_events", event="skipped")
+        return
+    if not mp3:
+        return
+
+    try:
+        await store_audio(bot, INLINE_STORAGE_CHAT_ID, mp3, title=title, performer=None)
+    except Exception as e:
+        log.warning(f"[Inline] ⚠ Не удалось загрузить в служебный чат: {e}")
+
+async def _fetch_track(text: str) -> tuple[str, str] | None:
+    """mp3 и название трека, которому ещё нужен file_id (None — искать нечего или уже есть)."""
+    entries = await search_youtube_list_async(text, limit=5)
+    if not entries:
+        return None
+    c = candidate(entries[0])
+    inc("inline_events", event="fetch")
+
+    cached = await get_by_youtube_id(c.id)
+    if cached and is_deliverable(cached):
+        # трек уже есть, просто не находился по этим словам
+        await save_track(c.id, cached["artist"], cached["title"], cached["mp3_path"], query=text)
+        return None if cached["audio_file_id"] else (cached["mp3_path"], c.title)
+
+    mp3 = await download_mp3(c.id, "Unknown", c.title)
+    if not mp3:
+        return None
+    await save_track(c.id, "Unknown", c.title, str(mp3), query=text)
+    await register(mp3)
+    run_background(index_track(c.id, mp3))
+    log.info(f"[Inline] ⏬ {text!r} → {c.title}")
+    return str(mp3), c.title
+
+def inline_stats() -> Dict[str, int]:
+    return {"pages": len(_pages), "pending": len(_pending)}
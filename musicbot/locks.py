@@ -0,0 +1,106 @@
+"""
+Межпроцессные блокировки для нескольких воркеров бота.
+
+Блокировка — это аренда с TTL: держатель продлевает её, пока работает,
+а упавший воркер не держит ключ дольше TTL. Бэкенд выбирается LOCK_BACKEND:
+    sqlite — таблица locks в общей cache.db;
+    redis  — SET NX PX в Redis-совместимом хранилище.
+Остальное общее состояние (ключи, клавиатуры, отпечатки) — в SQLite на локальном
+диске, поэтому все воркеры работают на одном хосте (см. CACHE_DIR в config).
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Protocol
+from .config import LOCK_BACKEND, LOCK_TTL, REDIS_URL, WORKER_ID, log
+from .db import try_lease, drop_lease
+
+# владелец аренды — процесс: после рестарта с тем же WORKER_ID старая аренда не считается своей
+OWNER = f"{WORKER_ID}:{os.getpid()}"
+
+class LockBackend(Protocol):
+    async def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        """Берёт или продлевает аренду; False — ключ держит другой владелец."""
+
+    async def release(self, key: str, owner: str) -> None:
+        """Снимает аренду, только если она наша."""
+
+class SqliteLocks:
+    async def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        return await try_lease(key, owner, time.time(), ttl)
+
+    async def release(self, key: str, owner: str) -> None:
+        await drop_lease(key, owner)
+
+# снять/продлить ключ, только если значение — наш owner
+_RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+_RENEW = (
+    "local v = redis.call('get', KEYS[1]) "
+    "if v == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end "
+    "if not v then return redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2]) and 1 or 0 end "
+    "return 0"
+)
+
+class RedisLocks:
+    """client — redis.asyncio.Redis или совместимая подмена (например, fakeredis в тестах)."""
+
+    def __init__(self, client, prefix: str = "musicbot:lock:"):
+        self.client = client
+        self.prefix = prefix
+
+    async def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        return bool(await self.client.eval(_RENEW, 1, self.prefix + key, owner, int(ttl * 1000)))
+
+    async def release(self, key: str, owner: str) -> None:
+        await self.client.eval(_RELEASE, 1, self.prefix + key, owner)
+
+def _make_backend() -> LockBackend:
+    if LOCK_BACKEND == "redis":
+        import redis.asyncio as redis     # опциональная зависимость, нужна только в этом режиме
+        return RedisLocks(redis.from_url(REDIS_URL))
+    return SqliteLocks()
+
+_backend: LockBackend | None = None
+
+def backend() -> LockBackend:
+    global _backend
+    if _backend is None:
+        _backend = _make_backend()
+    return _backend
+
+def set_backend(b: LockBackend):
+    global _backend
+    _backend = b
+
+@asynccontextmanager
+async def distributed_lock(key: str, ttl: float = LOCK_TTL, poll: float = 0.5):
+    """
+    Ждёт, пока ключ освободится в других воркерах, и держит его до выхода из блока.
+    Внутри процесса одинаковые задачи уже схлопывает single_flight — здесь только межпроцессная часть.
+    """
+    b = backend()
+    waited = 0.0
+    while not await b.acquire(key, OWNER, ttl):
+        if waited == 0:
+            log.info(f"[Lock] ⏳ {key} занят другим воркером — жду")
+        await asyncio.sleep(poll)
+        waited += poll
+
+    async def renew():
+        while True:
+            await asyncio.sleep(ttl / 3)
+            if not await b.acquire(key, OWNER, ttl):
+                log.warning(f"[Lock] ⚠ Аренда {key} перехвачена другим воркером")
+                return
+
+    renewer = asyncio.ensure_future(renew())
+    try:
+        yield
+    finally:
+        renewer.cancel()
+        await b.release(key, OWNER)
+
+async def try_lock(key: str, ttl: float) -> bool:
+    """Неблокирующая аренда (например, «лидер» для фоновых задач)."""
+    return await backend().acquire(key, OWNER, ttl)
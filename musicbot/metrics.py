@@ -0,0 +1,146 @@
+"""
+Метрики бота в формате Prometheus (без внешних зависимостей).
+
+    musicbot_stage_seconds{stage="audd"}          — гистограмма длительности этапа
+    musicbot_request_seconds{handler="video"}     — весь запрос от апдейта до ответа
+    musicbot_cache_lookups_total{key,result}      — попадания/промахи кэша по типу ключа
+    musicbot_prefetch_events_total{event}         — прочие счётчики (metrics.inc)
+    musicbot_scheduler_jobs{what="active"}        — текущая нагрузка (снимается при экспорте)
+"""
+import bisect
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict
+
+# границы корзин, сек: от быстрых запросов к базе до долгих загрузок
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам (линейно внутри корзины)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lo = BUCKETS[i - 1] if i else 0.0
+                hi = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1] * 2
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+_histograms: Dict[tuple[str, str, str], Histogram] = {}
+_counters: Dict[tuple[str, tuple], float] = {}
+_gauges: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+def observe(stage: str, seconds: float, metric: str = "stage", label: str = "stage"):
+    key = (metric, label, stage)
+    h = _histograms.get(key)
+    if h is None:
+        h = _histograms[key] = Histogram()
+    h.observe(seconds)
+
+@asynccontextmanager
+async def timed(stage: str, metric: str = "stage", label: str = "stage"):
+    """Замер этапа; время пишется и при исключении."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t0, metric, label)
+
+def request_timer(handler: str):
+    return timed(handler, metric="request", label="handler")
+
+def inc(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    _counters[key] = _counters.get(key, 0) + value
+
+def register_gauges(name: str, collect: Callable[[], Dict[str, float]]):
+    """collect() вызывается при экспорте и возвращает {what: значение}."""
+    _gauges[name] = collect
+
+def _labels(pairs) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in pairs)
+
+def render() -> str:
+    """Текстовый формат Prometheus exposition 0.0.4 (с # TYPE перед каждой метрикой)."""
+    lines = []
+    typed = set()
+
+    def declare(name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (metric, label, value), h in sorted(_histograms.items()):
+        name = f"musicbot_{metric}_seconds"
+        declare(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(BUCKETS, h.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {h.count}')
+        lines.append(f'{name}_sum{{{label}="{value}"}} {h.sum:.6f}')
+        lines.append(f'{name}_count{{{label}="{value}"}} {h.count}')
+    for (name, labels), v in sorted(_counters.items()):
+        declare(f"musicbot_{name}_total", "counter")
+        lines.append(f"musicbot_{name}_total{{{_labels(labels)}}} {v:g}" if labels else f"musicbot_{name}_total {v:g}")
+    for name, collect in sorted(_gauges.items()):
+        try:
+            values = collect()
+        except Exception:
+            continue
+        for what, v in sorted(values.items()):
+            if isinstance(v, (int, float)):
+                declare(f"musicbot_{name}", "gauge")
+                lines.append(f'musicbot_{name}{{what="{what}"}} {v:g}')
+    return "\n".join(lines) + "\n"
+
+def snapshot() -> Dict[str, Dict[str, float]]:
+    """{"stage/audd": {"count", "p50", "p95", "p99", "sum"}} — для бенчмарка и отчётов."""
+    return {
+        f"{metric}/{value}": {
+            "count": h.count, "sum": h.sum,
+            "p50": h.quantile(0.5), "p95": h.quantile(0.95), "p99": h.quantile(0.99),
+        }
+        for (metric, _, value), h in sorted(_histograms.items())
+    }
+
+def counters() -> Dict[str, float]:
+    """{"cache_lookups{key=url,result=hit}": n} — значения счётчиков для бенчмарка и отчётов."""
+    return {
+        f"{name}{{{','.join(f'{k}={v}' for k, v in labels)}}}" if labels else name: v
+        for (name, labels), v in sorted(_counters.items())
+    }
+
+def summary() -> str:
+    """Короткая сводка для /stats: квантили по этапам и запросам, счётчики."""
+    lines = []
+    for (metric, _, value), h in sorted(_histograms.items()):
+        lines.append(
+            f"{metric}/{value}: n={h.count} p50={h.quantile(0.5):.2f}s "
+            f"p95={h.quantile(0.95):.2f}s p99={h.quantile(0.99):.2f}s"
+        )
+    for (name, labels), v in sorted(_counters.items()):
+        lines.append(f"{name}{{{_labels(labels)}}} = {v:g}")
+    for name, collect in sorted(_gauges.items()):
+        try:
+            values = collect()
+        except Exception:
+            continue
+        lines.append(f"{name}: " + ", ".join(f"{k}={v}" for k, v in sorted(values.items())))
+    return "\n".join(lines) or "пока пусто"
@@ -0,0 +1,217 @@
+import asyncio
+import shutil
+import tempfile
+from pathlib import Path
+from telegram import Bot
+from .audio import Clip, Window, tg_download_video, tg_video_source, extract_clip, SNIP_END
+from .audd import recognize_cached, track_duration
+from .cache import record_lookup, register, is_deliverable
+from .config import AUDD_HEDGE_DELAY, RECOGNITION_WINDOWS, YTDLP_DOWNLOAD_TIMEOUT, YTDLP_SEARCH_TIMEOUT, log
+from .db import get_by_audio_hash, get_by_youtube_id, save_track
+from .fingerprint import lookup_audio, index_track
+from .locks import distributed_lock
+from .metrics import timed
+from .scheduler import stage
+from .singleflight import single_flight
+from .workers import run_blocking
+from .youtube import search_youtube_music_async, download_mp3, resolve_audio_stream, download_audio_window
+
+class PipelineError(Exception):
+    """Этап обработки не удался; текст исключения — сообщение для пользователя."""
+
+# ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background: set[asyncio.Task] = set()
+
+def run_background(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+# === Распознавание по звуку (одно на уникальный хэш) ===
+async def resolve_clip(clip: Clip) -> dict:
+    """
+    По окнам звука находит трек: кэш по хэшу → отпечаток → AUDD по окнам → YouTube → mp3.
+    Одновременные вызовы с одинаковым хэшем делят одну задачу.
+    """
+    return await single_flight(f"hash:{clip.ahash}", lambda: _resolve_clip(clip))
+
+async def _hedged(windows: list[Window]) -> dict | None:
+    """
+    Окна в AUDD по одному: следующее отправляется, только если предыдущее
+    не распознано или отвечает дольше AUDD_HEDGE_DELAY. Отправленный запрос
+    оплачен, даже если его потом отменить, — поэтому не шлём все окна сразу.
+    """
+    pending: set[asyncio.Task] = set()
+
+    def first_result(done) -> dict | None:
+        for t in done:
+            try:
+                if result := t.result():
+                    return result
+            except Exception as e:
+                log.error(f"[Pipeline] ❌ Окно упало: {e}")
+        return None
+
+    try:
+        for w in windows:
+            pending.add(asyncio.ensure_future(_by_audd(w)))
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=AUDD_HEDGE_DELAY, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break       # долго — подстрахуемся следующим окном
+                if result := first_result(done):
+                    return result
+        # окна кончились — ждём те, что ещё в полёте
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if result := first_result(done):
+                return result
+        return None
+    finally:
+        for t in pending:
+            t.cancel()
+
+async def _by_fingerprint(clip: Clip) -> dict | None:
+    # тот же трек мог прийти из другого видео: сверяем локальный отпечаток
+    async with timed("fingerprint"):
+        match = await lookup_audio(clip.pcm)
+    if match:
+        cached = await get_by_youtube_id(match.track_id)
+        record_lookup("fingerprint", bool(cached and is_deliverable(cached)))
+        if cached and is_deliverable(cached):
+            return dict(cached, cached=True)
+    return None
+
+async def _by_audd(window: Window) -> dict | None:
+    if result := await recognize_cached(window.path, window.ahash):
+        log.info(f"[Pipeline] 🎯 Распознано по окну {window.start}+{window.duration}s")
+    return result
+
+async def _resolve_clip(clip: Clip) -> dict:
+    async with timed("hash_lookup"):
+        cached = await get_by_audio_hash(clip.ahash)
+    record_lookup("audio_hash", bool(cached and is_deliverable(cached)))
+    if cached and is_deliverable(cached):
+        return dict(cached, cached=True)
+
+    # сначала бесплатный локальный отпечаток (~50 мс), платный AUDD — только при промахе
+    if cached := await _by_fingerprint(clip):
+        return cached
+
+    audd = await _hedged(clip.windows[:RECOGNITION_WINDOWS])
+    if not audd:
+        raise PipelineError("❌ Не удалось распознать трек.")
+
+    artist = audd.get("artist", "Unknown")
+    title = audd.get("title", "Unknown")
+    duration = track_duration(audd)
+
+    vid = await search_youtube_music_async(title, artist, duration)
+    if not vid:
+        raise PipelineError("⚠️ Не удалось найти трек на YouTube.")
+
+    # тот же трек уже скачан по другому запросу или кнопке — звук другой, а mp3 тот же
+    cached = await get_by_youtube_id(vid)
+    record_lookup("youtube_id", bool(cached and is_deliverable(cached)))
+    if cached and is_deliverable(cached):
+        return dict(cached, artist=artist, title=title, cached=True)
+
+    mp3 = await download_mp3(vid, artist, title)
+    if not mp3:
+        raise PipelineError("⚠️ Ошибка при скачивании MP3.")
+
+    run_background(index_track(vid, mp3))
+    return {"artist": artist, "title": title, "mp3_path": str(mp3), "youtube_id": vid, "cached": False}
+
+async def _remember(track: dict, ahash: str, url: str | None, video: str | None):
+    # трек уже в базе — добавятся только новые ключи (строк не прибавится)
+    await save_track(
+        track["youtube_id"],
+        track["artist"],
+        track["title"],
+        track["mp3_path"],
+        url=url,
+        ahash=ahash,
+        video=video,
+    )
+    if not track.get("cached"):
+        await register(Path(track["mp3_path"]))
+
+async def _resolve_shared(clip: Clip, url: str | None = None, video: str | None = None) -> dict:
+    # другой воркер с тем же звуком дождётся записи в базу и возьмёт трек из кэша
+    async with distributed_lock(f"hash:{clip.ahash}"):
+        track = await resolve_clip(clip)
+        await _remember(track, clip.ahash, url, video)
+    return track
+
+# === Видео из Telegram (одно на file_unique_id) ===
+async def ingest_video(bot: Bot, file_id: str, file_unique_id: str) -> dict:
+    return await single_flight(f"tg:{file_unique_id}", lambda: _ingest_video(bot, file_id, file_unique_id))
+
+async def _ingest_video(bot: Bot, file_id: str, file_unique_id: str) -> dict:
+    video = None
+    clip = None
+    try:
+        # сначала пробуем вырезать звук прямо из потока, без записи видео на диск
+        source = await tg_video_source(bot, file_id)
+        clip = await extract_clip(source)
+        if not clip and isinstance(source, str):
+            # например, контейнер без поддержки частичного чтения — качаем целиком
+            video = await tg_download_video(bot, file_id)
+            clip = await extract_clip(video)
+        if not clip:
+            raise PipelineError("⚠️ Не удалось извлечь звук из видео.")
+
+        track = await _resolve_shared(clip, video=file_unique_id)
+        return track
+    finally:
+        if clip:
+            clip.cleanup()
+        cleanup_files(video)
+
+# === Ссылка (одна обработка на URL) ===
+async def ingest_link(url: str) -> dict:
+    return await single_flight(f"url:{url}", lambda: _ingest_link(url))
+
+async def _ingest_link(url: str) -> dict:
+    clip = None
+    tmp_dir = Path(tempfile.mkdtemp(prefix="link_"))    # свой каталог на каждый запрос
+    try:
+        # сначала — прямой аудиопоток: ffmpeg читает только начало до конца последнего окна
+        try:
+            stream = await run_blocking(resolve_audio_stream, url, timeout=YTDLP_SEARCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            stream = None
+        if stream:
+            stream_url, headers = stream
+            clip = await extract_clip(stream_url, headers=headers)
+
+        # иначе качаем через yt-dlp только начало самого лёгкого формата
+        if not clip:
+            try:
+                async with stage("download"):
+                    source = await run_blocking(
+                        download_audio_window, url, tmp_dir, SNIP_END,
+                        timeout=YTDLP_DOWNLOAD_TIMEOUT,
+                    )
+            except Exception as e:
+                log.error(f"[Link] ❌ Ошибка загрузки {url}: {e}")
+                source = None
+            if source:
+                clip = await extract_clip(source)
+
+        if not clip:
+            raise PipelineError("⚠️ Не удалось извлечь звук из видео.")
+
+        track = await _resolve_shared(clip, url=url)
+        return track
+    finally:
+        if clip:
+            clip.cleanup()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def cleanup_files(*paths: Path):
+    for p in paths:
+        if p and p.exists():
+            p.unlink(missing_ok=True)
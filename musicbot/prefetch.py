@@ -0,0 +1,55 @@
+import asyncio
+from typing import Dict
+from .cache import is_deliverable
+from .config import PREFETCH_CANDIDATES, PREFETCH_MAX, log
+from .db import get_by_youtube_id
+from .metrics import inc
+from .scheduler import has_capacity
+from .youtube import download_mp3
+
+# спекулятивные загрузки по всем пользователям (для глобального лимита)
+_active: set[asyncio.Task] = set()
+
+def prefetch(candidates) -> Dict[str, asyncio.Task]:
+    """
+    Пока пользователь выбирает, качает первые PREFETCH_CANDIDATES кандидатов
+    (Candidate из choices; список уже отсортирован по _priority). Не больше PREFETCH_MAX загрузок сразу
+    и только если у этапа загрузки нет очереди из настоящих запросов.
+    handle_choice с тем же id присоединится к загрузке через single_flight.
+    """
+    tasks = {}
+    for c in candidates[:PREFETCH_CANDIDATES]:
+        vid = c.id
+        if not vid:
+            continue
+        if len(_active) >= PREFETCH_MAX or not has_capacity("download"):
+            inc("prefetch_events", event="skipped")
+            break
+        task = asyncio.ensure_future(_prefetch_one(vid, c.title))
+        _active.add(task)
+        task.add_done_callback(_active.discard)
+        tasks[vid] = task
+    return tasks
+
+async def _prefetch_one(vid: str, title: str):
+    # популярные варианты часто уже в кэше (под настоящим исполнителем) — не качаем второй раз
+    cached = await get_by_youtube_id(vid)
+    if cached and is_deliverable(cached):
+        inc("prefetch_events", event="cached")
+        return None
+    inc("prefetch_events", event="started")
+    log.info(f"[Prefetch] ⏬ {vid}: {title}")
+    return await download_mp3(vid, "Unknown", title)
+
+def release(tasks: Dict[str, asyncio.Task], keep: str | None = None):
+    """Отменяет спекулятивные загрузки, кроме выбранной (keep)."""
+    for vid, task in tasks.items():
+        if vid == keep:
+            inc("prefetch_events", event="used")
+        elif not task.done():
+            task.cancel()
+            inc("prefetch_events", event="cancelled")
+    tasks.clear()
+
+def prefetch_stats() -> Dict[str, int]:
+    return {"active": len(_active)}
@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict
+from .config import (
+    JOB_CONCURRENCY, JOB_QUEUE_SIZE, FFMPEG_CONCURRENCY, AUDD_CONCURRENCY, DOWNLOAD_CONCURRENCY, log,
+)
+
+# пользователь, от имени которого идёт текущая задача (наследуется вложенными тасками)
+current_user: contextvars.ContextVar[int] = contextvars.ContextVar("current_user", default=0)
+
+class QueueFull(Exception):
+    """Очередь заполнена — запрос не принят."""
+
+class FairLimiter:
+    """
+    Семафор с очередью по пользователям: освободившийся слот достаётся
+    следующему пользователю по кругу, а не тому, кто прислал больше запросов.
+    """
+
+    def __init__(self, name: str, limit: int, max_waiting: int | None = None):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self._queues: OrderedDict[int, deque[asyncio.Future]] = OrderedDict()
+
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, on_queued: Callable[[int], Awaitable] | None = None):
+        if self.active < self.limit and not self._queues:
+            self.active += 1
+        else:
+            await self._wait(on_queued)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _wait(self, on_queued):
+        if self.max_waiting is not None and self.waiting() >= self.max_waiting:
+            raise QueueFull(self.name)
+
+        user = current_user.get()
+        fut = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append(fut)
+        if on_queued:
+            try:
+                await on_queued(self.waiting())
+            except Exception as e:
+                log.warning(f"[Scheduler] ⚠ Не удалось сообщить позицию в очереди: {e}")
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # слот уже передан нам — отдаём следующему
+                self._release()
+            else:
+                q = self._queues.get(user)
+                if q and fut in q:
+                    q.remove(fut)
+                    if not q:
+                        del self._queues[user]
+            raise
+
+    def _release(self):
+        # слот не освобождается, а переходит первому в очереди следующего пользователя
+        while self._queues:
+            user, q = next(iter(self._queues.items()))
+            fut = q.popleft()
+            if q:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": self.active, "waiting": self.waiting(), "users": len(self._queues), "limit": self.limit}
+
+# входная очередь запросов и отдельные лимиты на тяжёлые этапы
+_jobs = FairLimiter("jobs", JOB_CONCURRENCY, max_waiting=JOB_QUEUE_SIZE)
+_stages = {
+    "ffmpeg": FairLimiter("ffmpeg", FFMPEG_CONCURRENCY),
+    "audd": FairLimiter("audd", AUDD_CONCURRENCY),
+    "download": FairLimiter("download", DOWNLOAD_CONCURRENCY),
+}
+
+@asynccontextmanager
+async def job(user_id: int, on_queued: Callable[[int], Awaitable] | None = None):
+    """
+    Запрос пользователя целиком. Если свободных слотов нет — встаёт в очередь
+    (on_queued получает позицию), если очередь полна — бросает QueueFull.
+    """
+    token = current_user.set(user_id)
+    try:
+        async with _jobs.slot(on_queued):
+            yield
+    finally:
+        current_user.reset(token)
+
+def stage(name: str):
+    """Слот этапа (ffmpeg, audd, download) для текущего пользователя."""
+    return _stages[name].slot()
+
+def has_capacity(name: str) -> bool:
+    """У этапа есть свободный слот и никто не ждёт."""
+    s = _stages[name]
+    return s.active < s.limit and not s.waiting()
+
+def scheduler_stats() -> Dict[str, Dict[str, int]]:
+    return {"jobs": _jobs.stats(), **{name: s.stats() for name, s in _stages.items()}}
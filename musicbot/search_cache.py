@@ -0,0 +1,83 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+from .config import SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_STALE, SEARCH_CACHE_SIZE, log
+from .db import get_search, save_search, purge_searches, tokens
+from .metrics import inc
+
+# горячие запросы в памяти: key -> (результат, время получения)
+_lru: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+_refreshing: Dict[str, asyncio.Task] = {}
+
+def _key_part(part) -> str:
+    if part is None:
+        return ""
+    text = str(part)
+    # запрос из одних знаков («!!!», «🔥🔥») слов не даёт — иначе все такие делили бы один ключ
+    return " ".join(tokens(text)) or text.strip().lower()
+
+def search_key(kind: str, *parts) -> str:
+    """Ключ без регистра, диакритики и пунктуации: «Beyoncé – Halo» == «beyonce halo»."""
+    return kind + ":" + "|".join(_key_part(p) for p in parts)
+
+def _remember(key: str, value: Any, created_at: float):
+    _lru[key] = (value, created_at)
+    _lru.move_to_end(key)
+    while len(_lru) > SEARCH_CACHE_SIZE:
+        _lru.popitem(last=False)
+
+async def _fetch(key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    value = await fetch()
+    # пустой результат (ошибка, таймаут) не кэшируем — следующий запрос попробует снова
+    if value:
+        now = time.time()
+        _remember(key, value, now)
+        await save_search(key, json.dumps(value, ensure_ascii=False), now)
+    return value
+
+def _refresh(key: str, fetch: Callable[[], Awaitable[Any]]):
+    if key in _refreshing:
+        return
+    task = asyncio.ensure_future(_fetch(key, fetch))
+    _refreshing[key] = task
+
+    def done(t: asyncio.Task):
+        _refreshing.pop(key, None)
+        if not t.cancelled() and t.exception():
+            log.warning(f"[Search] ⚠ Фоновое обновление {key} не удалось: {t.exception()}")
+    task.add_done_callback(done)
+
+async def cached_search(key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Результат поиска из памяти или SQLite. Устаревший (старше SEARCH_CACHE_TTL)
+    отдаётся сразу и обновляется в фоне; совсем старый (SEARCH_CACHE_MAX_STALE) — ищется заново.
+    """
+    now = time.time()
+    if key in _lru:
+        value, created_at = _lru[key]
+        _lru.move_to_end(key)
+        inc("search_cache_lookups", result="memory_hit")
+    elif row := await get_search(key):
+        value, created_at = json.loads(row[0]), row[1]
+        _remember(key, value, created_at)
+        inc("search_cache_lookups", result="db_hit")
+    else:
+        inc("search_cache_lookups", result="miss")
+        return await _fetch(key, fetch)
+
+    age = now - created_at
+    if age > SEARCH_CACHE_MAX_STALE:
+        inc("search_cache_lookups", result="miss")
+        return await _fetch(key, fetch) or value
+    if age > SEARCH_CACHE_TTL:
+        inc("search_cache_lookups", result="stale")
+        _refresh(key, fetch)
+    return value
+
+async def purge_search_cache() -> int:
+    return await purge_searches(time.time() - SEARCH_CACHE_MAX_STALE)
+
+def search_cache_stats() -> Dict[str, int]:
+    return {"memory": len(_lru), "refreshing": len(_refreshing)}
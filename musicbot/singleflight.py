@@ -0,0 +1,46 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+from .metrics import inc
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+_flights: Dict[str, _Flight] = {}
+
+async def single_flight(key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Схлопывает одинаковые параллельные запросы в одну задачу.
+    Первый вызов с ключом запускает factory(), остальные ждут тот же результат
+    (или то же исключение). Задача отменяется, только если её перестали ждать все.
+    """
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _Flight(asyncio.ensure_future(factory()))
+        _flights[key] = flight
+        flight.task.add_done_callback(lambda _t, f=flight: _forget(key, f))
+        inc("single_flight_calls", role="leader")
+    else:
+        inc("single_flight_calls", role="follower")
+
+    flight.waiters += 1
+    try:
+        return await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            flight.task.cancel()
+
+def _forget(key: str, flight: _Flight):
+    if _flights.get(key) is flight:
+        del _flights[key]
+
+def in_flight() -> int:
+    return len(_flights)
+
+def flight_stats() -> Dict[str, int]:
+    """Сколько задач выполняется сейчас (запущенные и присоединившиеся — счётчик single_flight_calls)."""
+    return {"in_flight": len(_flights)}
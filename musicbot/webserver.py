@@ -0,0 +1,66 @@
+"""
+Режим webhook: aiohttp принимает апдейты от Telegram и кладёт их в очередь
+приложения, сразу отвечая 200 — обработчики работают асинхронно.
+На публичном порту — только путь webhook; /metrics и /healthz в обоих режимах
+отдаёт отдельный сервер на localhost (METRICS_PORT).
+
+Локальная проверка без Telegram (записанный апдейт в update.json):
+    curl -X POST localhost:8080/telegram \
+         -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+         -H "Content-Type: application/json" -d @update.json
+"""
+import hmac
+import json
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+from .config import WEBHOOK_PATH, WEBHOOK_SECRET, log
+from .metrics import render
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def make_web_app(tg_app: Application) -> web.Application:
+    async def telegram(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400)
+        # валидный JSON, но не апдейт (список, нет update_id) — de_json падает с TypeError
+        if not isinstance(data, dict) or "update_id" not in data:
+            return web.Response(status=400)
+        try:
+            update = Update.de_json(data, tg_app.bot)
+        except (TypeError, ValueError, KeyError) as e:
+            log.warning(f"[Web] ⚠ Некорректный апдейт: {e}")
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        # очередь без ограничения — put не ждёт, Telegram получает ответ сразу
+        await tg_app.update_queue.put(update)
+        return web.Response()
+
+    app = web.Application(client_max_size=1024 * 1024)
+    app.router.add_post(WEBHOOK_PATH, telegram)
+    return app
+
+def make_metrics_app() -> web.Application:
+    """Только /metrics и /healthz, слушает localhost."""
+    async def metrics(_request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def health(_request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    app = web.Application(client_max_size=1024 * 1024)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/healthz", health)
+    return app
+
+async def start_web_server(app: web.Application, port: int, host: str = "0.0.0.0") -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f"[Web] 🌐 Слушаю {host}:{port}")
+    return runner
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+from .config import YTDLP_WORKERS, log
+from .metrics import inc
+
+# Отдельный пул для yt-dlp: медленный поиск/загрузка не должны занимать
+# дефолтный executor и тем более блокировать event loop.
+_pool: ThreadPoolExecutor | None = None
+_lock = threading.Lock()
+# текущая нагрузка; отправленные задачи и таймауты — счётчики ytdlp_pool_*
+_stats = {
+    "queued": 0,       # ждут свободного потока
+    "running": 0,      # выполняются сейчас
+    "max_queued": 0,
+}
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=YTDLP_WORKERS, thread_name_prefix="ytdlp")
+    return _pool
+
+def _run(fn: Callable, args: tuple) -> Any:
+    with _lock:
+        _stats["queued"] -= 1
+        _stats["running"] += 1
+    try:
+        return fn(*args)
+    finally:
+        with _lock:
+            _stats["running"] -= 1
+
+def _on_done(cf: Future):
+    # задача отменена по таймауту ещё в очереди — _run не выполнялся
+    if cf.cancelled():
+        with _lock:
+            _stats["queued"] -= 1
+
+async def run_blocking(fn: Callable, *args, timeout: float | None = None) -> Any:
+    """
+    Выполняет блокирующую функцию в пуле yt-dlp.
+    При таймауте бросает asyncio.TimeoutError; уже запущенный поток
+    доработает в фоне, но вызывающий handler освобождается сразу.
+    """
+    inc("ytdlp_pool_submitted")
+    with _lock:
+        _stats["queued"] += 1
+        _stats["max_queued"] = max(_stats["max_queued"], _stats["queued"])
+        if _stats["queued"] > YTDLP_WORKERS:
+            log.warning(f"[Workers] ⏳ Очередь yt-dlp: {_stats['queued']} (потоков {YTDLP_WORKERS})")
+
+    cf = _get_pool().submit(_run, fn, args)
+    cf.add_done_callback(_on_done)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(cf), timeout)
+    except asyncio.TimeoutError:
+        inc("ytdlp_pool_timeouts")
+        log.warning(f"[Workers] ⏱ {getattr(fn, '__name__', fn)} не уложился в {timeout} сек")
+        raise
+
+def pool_stats() -> Dict[str, int]:
+    """Снимок нагрузки пула: глубина очереди и активные потоки."""
+    with _lock:
+        return dict(_stats, workers=YTDLP_WORKERS)
+
+def shutdown_workers():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
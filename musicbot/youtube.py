@@ -1,12 +1,24 @@
 import asyncio
+import os
 import re
+import shutil
+import tempfile
 from pathlib import Path
 from yt_dlp import YoutubeDL
-from .config import MP3_DIR, log
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC, error
+from yt_dlp.utils import download_range_func
+from .config import FFMPEG, MP3_DIR, cover_bytes, YTDLP_SEARCH_TIMEOUT, YTDLP_DOWNLOAD_TIMEOUT, log
+from .workers import run_blocking
+from .locks import distributed_lock
+from .metrics import timed
+from .scheduler import stage
+from .search_cache import cached_search, search_key
+from .singleflight import single_flight
 COOKIES_FILE = Path(__file__).parent / "cookies.txt"
 MAX_VIDEO_DURATION = 300  # максимум 5 минут
+MAX_MP3_MB = 50           # лимит Telegram для ботов
+MP3_BITRATE = 192
+
+_LIST_FIELDS = ("id", "title", "duration", "uploader", "url", "_priority")
 
 # === Поиск оригинального или популярного трека ===
 def search_youtube_music(title: str, artist: str, duration: int | None = None) -> str | None:
@@ -86,71 +98,144 @@ def search_youtube_music(title: str, artist: str, duration: int | None = None) -
 
 # === Загрузка mp3 ===
 async def download_mp3(video_id: str, artist: str, title: str) -> Path | None:
-    """Скачивает трек в mp3, ограничивая битрейт и добавляет обложку."""
-    safe_title = f"{artist} - {title} [{video_id}]".strip()
-    safe_title = re.sub(r'[\\/*?:"<>|]', "_", safe_title)
-    dst = MP3_DIR / f"{safe_title}.mp3"
-    if dst.exists():
-        print(f"[Cache] ⚡ Уже есть: {dst.name}")
-        return dst
+    """Скачивает трек в mp3; параллельные загрузки одного video_id схлопываются в одну."""
+    return await single_flight(f"yt:{video_id}", lambda: _download_mp3(video_id, artist, title))
+
+def resolve_track(video_id: str) -> dict | None:
+    """Метаданные и прямая ссылка на лучший аудиоформат, без загрузки."""
+    ydl_opts = {"quiet": True, "skip_download": True, "noplaylist": True, "format": "bestaudio/best"}
+    if COOKIES_FILE.exists():
+        ydl_opts["cookiefile"] = str(COOKIES_FILE)
+    with YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+    return info if isinstance(info, dict) else None
 
+def download_source(video_id: str, dst_dir: Path) -> Path | None:
+    """Запасной путь для фрагментированных (DASH) потоков: исходный звук как есть, без перекодирования."""
     ydl_opts = {
         "format": "bestaudio/best",
         "quiet": True,
-        "outtmpl": str(MP3_DIR / f"{safe_title}.%(ext)s"),
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }],
-        "postprocessor_args": ["-b:a", "192k"],
+        "noplaylist": True,
+        "outtmpl": str(dst_dir / "source.%(ext)s"),
     }
-
-    loop = asyncio.get_event_loop()
+    if COOKIES_FILE.exists():
+        ydl_opts["cookiefile"] = str(COOKIES_FILE)
+    YoutubeDL(ydl_opts).download([f"https://www.youtube.com/watch?v={video_id}"])
+    files = [p for p in dst_dir.glob("source.*") if not p.name.endswith(".part")]
+    return files[0] if files else None
+
+async def transcode_mp3(source: Path | str, dst: Path, artist: str, title: str, headers: dict | None = None) -> bool:
+    """
+    Один проход ffmpeg: чтение источника (файл или URL — качается по ходу кодирования),
+    mp3 192k, ID3-теги и обложка из памяти через stdin (если она есть). Пишет во временный файл и переименовывает.
+    """
+    # уникальное имя: два процесса с одним dst не пишут в один файл; сирот подберёт reconcile
+    fd, name = tempfile.mkstemp(dir=MP3_DIR, prefix=f"{dst.stem}.", suffix=".part")
+    os.close(fd)
+    tmp = Path(name)
+    cmd = [FFMPEG, "-hide_banner", "-loglevel", "error", "-y"]
+    if isinstance(source, str):
+        cmd += ["-reconnect", "1", "-rw_timeout", "15000000"]
+        if headers:
+            cmd += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    cover = cover_bytes()
+    cmd += ["-i", str(source)]
+    if cover:
+        cmd += [
+            "-f", "jpeg_pipe", "-i", "pipe:0",      # обложка
+            "-map", "0:a:0", "-map", "1:v:0",
+            "-c:v", "copy", "-disposition:v", "attached_pic",
+            "-metadata:s:v", "title=Cover", "-metadata:s:v", "comment=Cover (front)",
+        ]
+    else:
+        cmd += ["-map", "0:a:0"]
+    cmd += [
+        "-c:a", "libmp3lame", "-b:a", f"{MP3_BITRATE}k",
+        "-id3v2_version", "3",
+        "-metadata", f"artist={artist}", "-metadata", f"title={title}",
+        "-f", "mp3", str(tmp),
+    ]
     try:
-        await loop.run_in_executor(
-            None,
-            lambda: YoutubeDL(ydl_opts).download([f"https://www.youtube.com/watch?v={video_id}"])
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if cover else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
         )
+        try:
+            _, err = await asyncio.wait_for(proc.communicate(cover), YTDLP_DOWNLOAD_TIMEOUT)
+        except BaseException:
+            # таймаут или отмена запроса — ffmpeg не должен качать дальше сам по себе
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    if proc.returncode or not tmp.exists():
+        log.error(f"[ffmpeg] ❌ Перекодирование не удалось: {err.decode(errors='ignore').strip()[-300:]}")
+        tmp.unlink(missing_ok=True)
+        return False
+    tmp.replace(dst)
+    return True
+
+async def _download_mp3(video_id: str, artist: str, title: str) -> Path | None:
+    """
+    Скачивает трек в mp3 с обложкой и тегами. Размер проверяется по метаданным
+    до загрузки; звук перекодируется прямо из потока, без промежуточного файла.
+    """
+    # имя только по id: одно видео — один файл, как бы его ни назвали (AUDD, кнопка, «Unknown»)
+    dst = MP3_DIR / f"{video_id}.mp3"
+    if dst.exists():
+        print(f"[Cache] ⚡ Уже есть: {dst.name}")
+        return dst
 
+    async with distributed_lock(f"yt:{video_id}"):
+        # пока ждали, трек мог скачать другой воркер
         if dst.exists():
-            size_mb = dst.stat().st_size / 1024 / 1024
-            if size_mb > 50:
-                print(f"[YouTube] ⚠️ Файл слишком большой ({size_mb:.1f} МБ) — удалён.")
-                dst.unlink(missing_ok=True)
+            print(f"[Cache] ⚡ Уже есть: {dst.name}")
+            return dst
+        return await _fetch_mp3(video_id, artist, title, dst)
+
+async def _fetch_mp3(video_id: str, artist: str, title: str, dst: Path) -> Path | None:
+    tmp_dir = None
+    try:
+        async with stage("download"), timed("download"):
+            info = await run_blocking(resolve_track, video_id, timeout=YTDLP_SEARCH_TIMEOUT)
+            if not info:
+                print("[YouTube] ⚠️ Не удалось получить метаданные.")
                 return None
 
-            print(f"[YouTube] 💾 Скачано: {dst.name} ({size_mb:.1f} МБ)")
+            # mp3 постоянного битрейта: размер известен заранее по длительности
+            duration = info.get("duration") or 0
+            size_mb = duration * MP3_BITRATE * 1000 / 8 / 1024 / 1024
+            if size_mb > MAX_MP3_MB:
+                print(f"[YouTube] ⚠️ Трек слишком длинный ({duration} сек, ~{size_mb:.1f} МБ) — пропускаю.")
+                return None
 
-            # 🖼️ Добавляем обложку
-            try:
-                cover_path = Path("assets/logo1.jpg")
-                if cover_path.exists():
-                    audio = MP3(dst, ID3=ID3)
-                    try:
-                        audio.add_tags()
-                    except error:
-                        pass
-                    with open(cover_path, "rb") as img:
-                        audio.tags.add(APIC(
-                            encoding=3,
-                            mime="image/jpeg",
-                            type=3,
-                            desc="Cover",
-                            data=img.read()
-                        ))
-                    audio.save(v2_version=3)
-                    print(f"[Tag] 🖼️ Обложка добавлена в {dst.name}")
-            except Exception as e:
-                print(f"[Tag] ❌ Ошибка добавления обложки: {e}")
+            if info.get("url") and info.get("protocol") in _STREAMABLE:
+                ok = await transcode_mp3(info["url"], dst, artist, title, headers=info.get("http_headers"))
+            else:
+                tmp_dir = Path(tempfile.mkdtemp(prefix="dl_"))
+                source = await run_blocking(download_source, video_id, tmp_dir, timeout=YTDLP_DOWNLOAD_TIMEOUT)
+                ok = bool(source) and await transcode_mp3(source, dst, artist, title)
 
+        if ok:
+            print(f"[YouTube] 💾 Скачано: {dst.name} ({dst.stat().st_size / 1024 / 1024:.1f} МБ)")
             return dst
 
         print("[YouTube] ⚠️ Файл не найден после загрузки.")
         return None
+    except asyncio.TimeoutError:
+        log.error(f"[YouTube] ⏱ Загрузка {video_id} превысила {YTDLP_DOWNLOAD_TIMEOUT} сек")
+        return None
     except Exception as e:
         log.error(f"[YouTube] ❌ Ошибка загрузки: {e}")
         return None
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
 def search_youtube_list(query: str, limit: int = 10) -> list[dict]:
     """Поиск YouTube с приоритетом официальных и лейблов (включая 'Provided to YouTube')."""
@@ -221,4 +306,114 @@ def search_youtube_list(query: str, limit: int = 10) -> list[dict]:
     # 📊 Сортировка по приоритету
     results.sort(key=lambda x: x.get("_priority", 0), reverse=True)
 
-    return results[:limit]
\ No newline at end of file
+    # храним только то, что нужно клавиатуре и загрузке (результат кэшируется)
+    return [{k: v.get(k) for k in _LIST_FIELDS} for v in results[:limit]]
+
+
+# === Звук по ссылке для распознавания (только нужный кусок) ===
+# самый маленький аудио-формат; если аудио отдельно нет — самое лёгкое видео
+_SMALLEST_AUDIO = {
+    "format": "ba/b",
+    "format_sort": ["+size", "+br", "+res"],
+}
+_STREAMABLE = {"http", "https", "m3u8", "m3u8_native"}
+
+def resolve_audio_stream(url: str) -> tuple[str, dict] | None:
+    """
+    Прямая ссылка на самый лёгкий аудиопоток и заголовки к ней.
+    ffmpeg читает из неё только окно фрагмента. None — если поток фрагментирован
+    (DASH) или извлечь не удалось.
+    """
+    ydl_opts = {"quiet": True, "skip_download": True, "noplaylist": True, **_SMALLEST_AUDIO}
+    if COOKIES_FILE.exists():
+        ydl_opts["cookiefile"] = str(COOKIES_FILE)
+
+    try:
+        with YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        print(f"[YouTube] ❌ Не удалось получить поток: {e}")
+        return None
+
+    if not isinstance(info, dict) or not info.get("url") or info.get("protocol") not in _STREAMABLE:
+        return None
+    print(f"[YouTube] 🎚 Поток для фрагмента: {info.get('format_id')} ({info.get('ext')}, {info.get('filesize') or '?'} байт)")
+    return info["url"], info.get("http_headers") or {}
+
+def download_audio_window(url: str, dst_dir: Path, end: int) -> Path | None:
+    """Запасной путь: скачивает только первые end секунд самого лёгкого формата."""
+    ydl_opts = {
+        "quiet": True,
+        "noplaylist": True,
+        "outtmpl": str(dst_dir / "source.%(ext)s"),
+        "download_ranges": download_range_func(None, [(0, end)]),
+        **_SMALLEST_AUDIO,
+    }
+    if COOKIES_FILE.exists():
+        ydl_opts["cookiefile"] = str(COOKIES_FILE)
+
+    YoutubeDL(ydl_opts).download([url])
+    files = [p for p in dst_dir.glob("source.*") if not p.name.endswith(".part")]
+    return files[0] if files else None
+
+# === Плейлисты ===
+# ссылка именно на плейлист/альбом (watch?v=...&list=... — это одно видео, noplaylist)
+_PLAYLIST = re.compile(r"/playlist\?|/sets/|/album/")
+
+def is_playlist(url: str) -> bool:
+    return bool(_PLAYLIST.search(url))
+
+def expand_playlist(url: str, limit: int) -> list[str]:
+    """Ссылки на первые limit видео плейлиста — одним запросом, без метаданных каждого видео."""
+    ydl_opts = {"quiet": True, "skip_download": True, "extract_flat": "in_playlist", "playlistend": limit}
+    if COOKIES_FILE.exists():
+        ydl_opts["cookiefile"] = str(COOKIES_FILE)
+    with YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if not isinstance(info, dict):
+        return []
+    if info.get("_type") != "playlist":
+        return [url]
+
+    urls = []
+    for entry in info.get("entries") or []:
+        if not entry:
+            continue
+        if entry.get("ie_key") == "Youtube" and entry.get("id"):
+            urls.append(f"https://www.youtube.com/watch?v={entry['id']}")
+        elif entry.get("url"):
+            urls.append(entry["url"])
+    print(f"[YouTube] 📃 Плейлист {info.get('title') or url}: {len(urls)} видео")
+    return urls[:limit]
+
+# === Асинхронные обёртки (пул yt-dlp, не блокируют event loop) ===
+async def search_youtube_music_async(title: str, artist: str, duration: int | None = None) -> str | None:
+    """Поиск с кэшем по нормализованным артисту/названию (длительность — с точностью до 5 сек)."""
+    key = search_key("music", artist, title, (duration or 0) // 5)
+    return await cached_search(key, lambda: _search_music(title, artist, duration))
+
+@timed("youtube_search")
+async def _search_music(title: str, artist: str, duration: int | None) -> str | None:
+    try:
+        return await single_flight(
+            f"search:{artist}|{title}|{duration}",
+            lambda: run_blocking(search_youtube_music, title, artist, duration, timeout=YTDLP_SEARCH_TIMEOUT),
+        )
+    except asyncio.TimeoutError:
+        print(f"[YouTube] ⏱ Поиск '{artist} {title}' превысил {YTDLP_SEARCH_TIMEOUT} сек")
+        return None
+
+async def search_youtube_list_async(query: str, limit: int = 10) -> list[dict]:
+    """Список кандидатов; повторный запрос отдаётся из кэша мгновенно."""
+    return await cached_search(search_key("list", query, limit), lambda: _search_list(query, limit))
+
+@timed("youtube_search")
+async def _search_list(query: str, limit: int) -> list[dict]:
+    try:
+        return await single_flight(
+            f"list:{query}|{limit}",
+            lambda: run_blocking(search_youtube_list, query, limit, timeout=YTDLP_SEARCH_TIMEOUT),
+        )
+    except asyncio.TimeoutError:
+        print(f"[YouTube] ⏱ Поиск '{query}' превысил {YTDLP_SEARCH_TIMEOUT} сек")
+        return []